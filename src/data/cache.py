@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from src.data.parquet_loader import SPLIT_NAMES, read_split_matrix, split_datasets
+
+# On-disk cache of the preprocessed train/validation/test splits.
+# The first call reads the parquet file, splits it and builds the datasets (see parquet_loader.py),
+# then saves the split indices, the count matrix, the lib sizes and the context encodings as .npy/.npz files.
+# Later calls memory-map the .npy files and hand the precomputed arrays to FlattenedDataset.from_arrays,
+# so neither train_test_split, the k-mer regex parsing, the one-hot construction nor the lib sizes are redone.
+#
+# Entries are keyed by a hash of the parquet file content and of every setting that changes the result
+# (label column, split ratios, seed, scaling_type). A changed file or setting gives a new key; the old
+# entries of the same file are then removed, so the cache does not grow with every edit of the data.
+
+CACHE_VERSION = 1 # bump when the layout of an entry changes
+
+
+def file_digest(path, block_size=2**22):
+    """blake2b digest of the file content, read in blocks"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(path, label_column='Tumor_Type', test_size=0.3, val_size=0.5, seed=1, scaling_type='mean'):
+    """hash of the parquet content and the preprocessing settings"""
+    settings = json.dumps({
+        'version': CACHE_VERSION,
+        'content': file_digest(path),
+        'label_column': label_column,
+        'test_size': test_size,
+        'val_size': val_size,
+        'seed': seed,
+        'scaling_type': scaling_type,
+    }, sort_keys=True)
+    return hashlib.blake2b(settings.encode(), digest_size=16).hexdigest()
+
+
+def _entry_dir(path, key, cache_dir):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}-{key}")
+
+
+def _remove_stale(path, entry, cache_dir):
+    """remove the entries of the same source file with another key"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for name in os.listdir(cache_dir):
+        other = os.path.join(cache_dir, name)
+        if other != entry and name.rsplit('-', 1)[0] == stem and os.path.isdir(other):
+            shutil.rmtree(other, ignore_errors=True)
+
+
+def _to_list(values):
+    return None if values is None else np.asarray(values).tolist()
+
+
+def _write_entry(entry, datasets, matrix, labels, kmer_names, sample_ids, splits):
+    """write to a temporary directory first, so an interrupted write never leaves a half-filled entry"""
+    tmp = entry + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    train = datasets['train']
+
+    np.save(os.path.join(tmp, 'matrix.npy'), matrix)
+    np.save(os.path.join(tmp, 'context_matrix.npy'), train.context_matrix.numpy())
+    for name in SPLIT_NAMES:
+        np.save(os.path.join(tmp, f'lib_{name}.npy'), datasets[name].lib_values.numpy())
+    np.savez(os.path.join(tmp, 'splits.npz'), **splits)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({
+            'kmer_names': list(kmer_names),
+            'mut_labels': train.mut_labels,
+            'labels': _to_list(labels),
+            'sample_ids': _to_list(sample_ids),
+        }, f)
+
+    shutil.rmtree(entry, ignore_errors=True)
+    os.rename(tmp, entry)
+
+
+def _read_entry(entry, return_onehot, scaling_type):
+    """memory-map the arrays of an entry and build the datasets from them"""
+    load = lambda name: np.load(os.path.join(entry, name), mmap_mode='c') # copy-on-write, the files are never modified
+    with open(os.path.join(entry, 'meta.json')) as f:
+        meta = json.load(f)
+    with np.load(os.path.join(entry, 'splits.npz')) as npz:
+        splits = {name: npz[name] for name in SPLIT_NAMES}
+
+    context_matrix = load('context_matrix.npy')
+    precomputed = {
+        name: {
+            'lib_values': load(f'lib_{name}.npy'),
+            'context_matrix': context_matrix,
+            'mut_labels': meta['mut_labels'],
+        }
+        for name in SPLIT_NAMES
+    }
+    sample_ids = None if meta['sample_ids'] is None else np.array(meta['sample_ids'], dtype=object)
+    datasets = split_datasets(
+        load('matrix.npy'), np.array(meta['labels'], dtype=object), meta['kmer_names'], sample_ids, splits,
+        precomputed=precomputed, scaling_type=scaling_type, return_onehot=return_onehot
+    )
+    return datasets, splits
+
+
+def load_cached_splits(path, label_column='Tumor_Type', test_size=0.3, val_size=0.5, seed=1, scaling_type='mean',
+                       return_onehot=True, cache_dir='.dgd_cache'):
+    """
+    Cached version of parquet_loader.load_flattened_splits.
+
+    Args:
+        path: parquet file, e.g. to_dgd.parquet
+        label_column, test_size, val_size, seed: see parquet_loader.split_indices
+        scaling_type: lib size of the datasets ('mean', 'max' or 'sum')
+        return_onehot: see FlattenedDataset (not part of the key, the context encodings are always stored)
+        cache_dir: directory of the cache entries
+
+    Returns:
+        dict with the datasets ('train', 'validation', 'test') and dict with the original row indices of each split
+    """
+    key = cache_key(path, label_column, test_size, val_size, seed, scaling_type)
+    entry = _entry_dir(path, key, cache_dir)
+    if os.path.isfile(os.path.join(entry, 'meta.json')):
+        return _read_entry(entry, return_onehot, scaling_type)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    _remove_stale(path, entry, cache_dir)
+    matrix, labels, kmer_names, sample_ids, splits = read_split_matrix(path, label_column, test_size, val_size, seed)
+    datasets = split_datasets(matrix, labels, kmer_names, sample_ids, splits,
+                              scaling_type=scaling_type, return_onehot=return_onehot)
+    _write_entry(entry, datasets, matrix, labels, kmer_names, sample_ids, splits)
+    return datasets, splits
@@ -41,4 +41,21 @@ class GeneExpressionDataset(Dataset):
     def __getlabel__(self, idx=None):
         if idx is None:
             idx = np.arange(self.__len__())
-        return self.label[idx]
\ No newline at end of file
+        return self.label[idx]
+
+    def precompute_log_factorial(self):
+        """
+        Precomputes the target-only term lgamma(count + 1) of the NB log-likelihood, which never changes
+        (log_factorial_data, same shape as data) and its sum over the dataset (log_factorial_sum).
+        """
+        self.log_factorial_data = torch.lgamma(self.data + 1)
+        self.log_factorial_sum = self.log_factorial_data.double().sum().item()
+        return self
+
+    def log_factorial(self, idx=None):
+        """lgamma(expression + 1) of the samples idx (as returned by __getitem__)"""
+        if not hasattr(self, "log_factorial_data"):
+            self.precompute_log_factorial()
+        if idx is None:
+            idx = np.arange(self.__len__())
+        return self.log_factorial_data[idx,:]
@@ -1,35 +1,86 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, Subset, BatchSampler, RandomSampler, SequentialSampler
 import numpy as np
 import re
+import copy
+
+# One-hot encoder for nucleotides
+nuc_to_vec = {'A': [1, 0, 0, 0],
+              'C': [0, 1, 0, 0],
+              'G': [0, 0, 1, 0],
+              'T': [0, 0, 0, 1]}
+
+def onehot_kmer(kmer):
+    """Convert k-mer string (e.g. AC[C>T]GA) to one-hot matrix of shape (k, 4)"""
+    nucleotides = re.findall(r'[ACGT]', kmer.upper())
+    return np.array([nuc_to_vec[n] for n in nucleotides], dtype=np.float32)
+
+def build_context_matrix(kmer_names):
+    """Stack the flattened one-hot encodings of all k-mers into a (num_muts, 4k) tensor, row i belonging to mut_idx i"""
+    return torch.from_numpy(np.stack([onehot_kmer(kmer).flatten() for kmer in kmer_names]))
 
 class FlattenedDataset(Dataset):
-    def __init__(self, gtex, label_position=-1, scaling_type='mean'):
-        self.scaling_type = scaling_type
+    def __init__(self, gtex, label_position=-1, scaling_type='mean', return_onehot=True):
         self.label_position = label_position
 
-        # Extract sample labels (tumor type)
-        self.labels = gtex.iloc[:, label_position].values
+        # Extract input features only (excluding label column)
+        counts = gtex.drop(gtex.columns[[label_position]], axis=1)
+        self._setup(
+            torch.tensor(counts.values).float(),
+            gtex.iloc[:, label_position].values, # sample labels (tumor type)
+            counts.columns.tolist(), # mutation context names
+            gtex.index.values,
+            scaling_type, return_onehot,
+        )
+
+    @classmethod
+    def from_arrays(cls, mut_matrix, labels, kmer_names, sample_ids=None, scaling_type='mean', return_onehot=True,
+                    lib_values=None, context_matrix=None, mut_labels=None):
+        '''
+        Build the dataset from a (num_samples, num_muts) count array instead of a dataframe.
+        A float32 numpy array (or a row slice of one) is wrapped with torch.from_numpy without copying,
+        see src/data/parquet_loader.py. lib_values, context_matrix and mut_labels can be passed
+        if they were computed before (see src/data/cache.py), otherwise they are computed here.
+        '''
+        dataset = cls.__new__(cls)
+        dataset.label_position = None
+        if isinstance(mut_matrix, np.ndarray):
+            mut_matrix = torch.from_numpy(mut_matrix)
+        if isinstance(lib_values, np.ndarray):
+            lib_values = torch.from_numpy(lib_values)
+        if isinstance(context_matrix, np.ndarray):
+            context_matrix = torch.from_numpy(context_matrix)
+        dataset._setup(mut_matrix.float(), np.asarray(labels), list(kmer_names), sample_ids, scaling_type, return_onehot,
+                       lib_values, context_matrix, mut_labels)
+        return dataset
+
+    def _setup(self, mut_matrix, labels, kmer_names, sample_ids, scaling_type, return_onehot,
+               lib_values=None, context_matrix=None, mut_labels=None):
+        self.scaling_type = scaling_type
+        # if False, only integer indices are returned and the context encodings are gathered on the model side (see ContextEncoding)
+        self.return_onehot = return_onehot
 
-        # Extract mutation context names
-        self.kmer_names = gtex.drop(gtex.columns[[label_position]], axis=1).columns.tolist()
+        self.labels = labels
+        self.kmer_names = kmer_names
+        self.sample_ids = sample_ids # e.g. Donor_ID, to attach to the learned representations
 
         # Extract mutation labels  
-        self.mut_labels = []
-        for kmer in self.kmer_names:
-            # Extract mutation label from format like [C>T]
-            match = re.search(r'\[([ACGT]>[ACGT])\]', kmer.upper())
-            mut_label = f"[{match.group(1)}]" if match else "[UNK]"
-            self.mut_labels.append(mut_label)
-        
-        # Extract input features only (excluding label column)
-        self.mut_matrix = torch.tensor(
-            gtex.drop(gtex.columns[[label_position]], axis=1).values
-        ).float()
+        self.mut_labels = mut_labels
+        if self.mut_labels is None:
+            self.mut_labels = []
+            for kmer in self.kmer_names:
+                # Extract mutation label from format like [C>T]
+                match = re.search(r'\[([ACGT]>[ACGT])\]', kmer.upper())
+                mut_label = f"[{match.group(1)}]" if match else "[UNK]"
+                self.mut_labels.append(mut_label)
+
+        self.mut_matrix = mut_matrix
 
         self.num_samples, self.num_muts = self.mut_matrix.shape
         # Precompute lib sizes
-        if self.scaling_type == 'mean':
+        if lib_values is not None:
+            self.lib_values = lib_values
+        elif self.scaling_type == 'mean':
             self.lib_values = self.mut_matrix.mean(dim=1, keepdim=True)
         elif self.scaling_type == 'max':
             self.lib_values = self.mut_matrix.max(dim=1, keepdim=True).values
@@ -38,43 +89,201 @@ class FlattenedDataset(Dataset):
         else:
             raise ValueError("Invalid scaling_type")
 
-        # Precompute the flattened index map: one row per sample–mutation pair
-        self.flattened_indices = [
-            (sample_idx, mut_idx)
-            for sample_idx in range(self.num_samples)
-            for mut_idx in range(self.num_muts)
-        ]
+        # One row per sample–mutation pair. Row i is the pair divmod(i, num_muts), so no index map is stored.
+        # Views (subset, shuffled, per tumor type) instead keep their flat indices in a compact int array.
+        self.row_index = None
 
-        # onehot encode each column name
-        
-        # One-hot encoder for nucleotides
-        nuc_to_vec = {'A': [1, 0, 0, 0],
-                      'C': [0, 1, 0, 0],
-                      'G': [0, 0, 1, 0],
-                      'T': [0, 0, 0, 1]}
-        
-        # Convert k-mer string to one-hot matrix
-        def onehot_kmer(kmer):
-            nucleotides = re.findall(r'[ACGT]', kmer.upper())
-            return np.array([nuc_to_vec[n] for n in nucleotides], dtype=np.float32) 
-        
-        # Dictionary of one-hot k-mers: shape (k, 4) for each
+        # onehot encode each column name, stacked into one (num_muts, 4k) matrix, so a whole batch can be gathered by mut_idx
+        self.context_matrix = context_matrix
+        if self.context_matrix is None:
+            self.context_matrix = build_context_matrix(self.kmer_names)
+
+        # Dictionary of one-hot k-mers: shape (k, 4) for each (views into context_matrix)
         self.kmer_onehots = {
-            kmer: torch.tensor(onehot_kmer(kmer)) for kmer in self.kmer_names
+            kmer: self.context_matrix[i].view(-1, 4) for i, kmer in enumerate(self.kmer_names)
         }
 
     def __len__(self):
-        # Total number of sample–mutation pairs
-        return len(self.flattened_indices)
+        # Total number of sample–mutation pairs (in this view)
+        if self.row_index is None:
+            return self.num_samples * self.num_muts
+        return len(self.row_index)
 
     def __getitem__(self, idx):
-        sample_idx, mut_idx = self.flattened_indices[idx] # idx are the indices for the current batch
+        if not isinstance(idx, (int, np.integer)):
+            return self.get_batch(idx)
+        if self.row_index is not None:
+            idx = int(self.row_index[idx])
+        sample_idx, mut_idx = divmod(idx, self.num_muts) # idx are the indices for the current batch
         value = self.mut_matrix[sample_idx, mut_idx].unsqueeze(0)
 
         # Use precomputed lib
         lib = self.lib_values[sample_idx]
         
-        kmer = self.kmer_names[mut_idx]
-        onehot = self.kmer_onehots[kmer].flatten() # onehot encoding for the given mutation context (mut_idx)
+        if not self.return_onehot:
+            return value, lib, sample_idx, mut_idx
+
+        onehot = self.context_matrix[mut_idx] # onehot encoding for the given mutation context (mut_idx)
+
+        return value, lib, sample_idx, mut_idx, onehot # add return of the onehot encoded mut context
+
+    def get_batch(self, idx):
+        """
+        Batched version of __getitem__. Takes a list/array/tensor of flat indices and
+        returns the same five outputs as a collated DataLoader batch, each built with one gather.
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        if self.row_index is not None:
+            idx = self.row_index[idx].long()
+        # flat indices are ordered sample-major, so the pair can be recovered arithmetically
+        sample_idx = torch.div(idx, self.num_muts, rounding_mode='floor')
+        mut_idx = idx % self.num_muts
+
+        value = self.mut_matrix[sample_idx, mut_idx].unsqueeze(1)
+        lib = self.lib_values[sample_idx]
+
+        if not self.return_onehot:
+            return value, lib, sample_idx, mut_idx
+
+        onehot = self.context_matrix[mut_idx]
+
+        return value, lib, sample_idx, mut_idx, onehot
+
+    def precompute_log_factorial(self, chunk_rows=1024):
+        """
+        Precomputes the target-only term lgamma(count + 1) of the NB log-likelihood, which never changes:
+        a lookup table over the integer counts of the whole matrix (log_factorial_table, shared with the views)
+        and the sum over the cells of this dataset (log_factorial_sum, e.g. to turn an optimization-only loss
+        back into the exact likelihood). For a view the sum only covers the view's rows, so views do not
+        inherit it and call this themselves. Non-integer counts get no table and are computed with lgamma on the fly.
+        """
+        max_count = 0.
+        integer = True
+        for start in range(0, self.num_samples, chunk_rows):
+            block = self.mut_matrix[start:start + chunk_rows]
+            max_count = max(max_count, block.max().item())
+            integer = integer and bool((block == block.round()).all() and (block >= 0).all())
+        self.log_factorial_table = None
+        if integer:
+            self.log_factorial_table = torch.lgamma(torch.arange(int(max_count) + 1, dtype=torch.float32) + 1)
+
+        total = 0.
+        if self.row_index is None:
+            for start in range(0, self.num_samples, chunk_rows):
+                total += torch.lgamma(self.mut_matrix[start:start + chunk_rows].double() + 1).sum().item()
+        else:
+            # only the cells of this view, gathered chunk by chunk
+            chunk = chunk_rows * self.num_muts
+            for start in range(0, len(self.row_index), chunk):
+                idx = self.row_index[start:start + chunk].long()
+                value = self.mut_matrix[torch.div(idx, self.num_muts, rounding_mode='floor'), idx % self.num_muts]
+                total += torch.lgamma(value.double() + 1).sum().item()
+        self.log_factorial_sum = total
+        return self
+
+    def log_factorial(self, value):
+        """lgamma(value + 1) of a batch of counts (e.g. the first batch output), on the device of value"""
+        if getattr(self, "log_factorial_table", None) is None:
+            if not hasattr(self, "log_factorial_sum"):
+                self.precompute_log_factorial()
+            if self.log_factorial_table is None:
+                return torch.lgamma(value + 1)
+        if self.log_factorial_table.device != value.device:
+            self.log_factorial_table = self.log_factorial_table.to(value.device)
+        return self.log_factorial_table[value.long()]
+
+    def _view(self, flat_idx):
+        """shallow copy of the dataset that shares all tensors but iterates over flat_idx only"""
+        flat_idx = torch.as_tensor(flat_idx).long()
+        if self.row_index is not None:
+            flat_idx = self.row_index[flat_idx].long()
+        view = copy.copy(self)
+        view.__dict__.pop("log_factorial_sum", None) # covers the parent's rows, see precompute_log_factorial
+        dtype = torch.int32 if self.num_samples * self.num_muts < 2**31 else torch.int64
+        view.row_index = flat_idx.to(dtype)
+        return view
+
+    def subset(self, idx):
+        """view over the rows idx (positions in this dataset, as passed to __getitem__)"""
+        return self._view(idx)
+
+    def shuffled(self, generator=None):
+        """view over all rows of this dataset in a random order"""
+        return self._view(torch.randperm(len(self), generator=generator))
+
+    def sample_view(self, sample_ids):
+        """view over all rows belonging to the given samples. sample_idx keeps pointing into the full dataset."""
+        sample_ids = torch.as_tensor(sample_ids).long()
+        if self.row_index is not None:
+            # keep only the rows that are part of this view, in the view's order:
+            # a mask over the samples, looked up per row, so memory scales with the view and not num_samples * num_muts
+            keep = torch.zeros(self.num_samples, dtype=torch.bool)
+            keep[sample_ids] = True
+            view_samples = torch.div(self.row_index.long(), self.num_muts, rounding_mode='floor')
+            return self._view(torch.nonzero(keep[view_samples]).squeeze(1))
+        flat_idx = (sample_ids.unsqueeze(1) * self.num_muts + torch.arange(self.num_muts)).flatten()
+        return self._view(flat_idx)
+
+    def tumor_type_view(self, tumor_types):
+        """view over all rows of samples with the given tumor type label(s)"""
+        mask = np.isin(self.labels, np.atleast_1d(tumor_types))
+        return self.sample_view(np.flatnonzero(mask))
+
+
+def batch_loader(dataset, batch_size, shuffle=False, drop_last=False, **kwargs):
+    """
+    DataLoader that fetches whole batches through dataset.get_batch instead of one row at a time.
+    A BatchSampler hands each list of indices to the dataset, and automatic batching (default_collate)
+    is switched off with batch_size=None. Extra kwargs (e.g. num_workers) are passed on to the DataLoader.
+    """
+    if shuffle:
+        sampler = RandomSampler(dataset)
+    else:
+        sampler = SequentialSampler(dataset)
+    return DataLoader(dataset,
+                      sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last),
+                      batch_size=None,
+                      **kwargs)
+
+
+def sample_loader(loader, sample_ids):
+    """
+    Loader like the given one (batch size, shuffling, batched or per-row), but over the rows of the given samples only,
+    e.g. to leave out samples whose representations have converged. sample_idx keeps pointing into the full dataset.
+    Works for DataLoaders over a FlattenedDataset (see sample_view), over a dataset with one row per sample
+    (e.g. GeneExpressionDataset, through a Subset) and for ResidentLoaders.
+    """
+    sample_ids = torch.as_tensor(sample_ids).long()
+    if not isinstance(loader, DataLoader):
+        return loader.sample_view(sample_ids) # ResidentLoader
+    dataset = loader.dataset
+    if hasattr(dataset, 'sample_view'):
+        view = dataset.sample_view(sample_ids.cpu())
+    else:
+        view = Subset(dataset, sample_ids.cpu().tolist())
+    return _loader_like(loader, view)
+
+
+def without_onehot(loader):
+    """
+    Loader like the given one, over a shallow copy of its dataset with return_onehot=False, so the batches
+    only carry value, lib, sample_idx and mut_idx and the context encodings are gathered on the device
+    (see ContextEncoding). Loaders that do not ship the onehot are returned unchanged.
+    """
+    if not getattr(loader.dataset, 'return_onehot', False):
+        return loader
+    if not isinstance(loader, DataLoader):
+        return loader.without_onehot() # ResidentLoader
+    dataset = copy.copy(loader.dataset) # shares all tensors
+    dataset.return_onehot = False
+    return _loader_like(loader, dataset)
+
 
-        return value, lib, sample_idx, mut_idx, onehot # add return of the onehot encoded mut context
\ No newline at end of file
+def _loader_like(loader, dataset):
+    """DataLoader over dataset with the batch size, shuffling and batching (per-row or batch_loader) of loader"""
+    if loader.batch_size is None: # batch_loader: the BatchSampler is the sampler
+        batches = loader.sampler
+        return batch_loader(dataset, batches.batch_size, shuffle=isinstance(batches.sampler, RandomSampler),
+                            drop_last=batches.drop_last, num_workers=loader.num_workers)
+    return DataLoader(dataset, batch_size=loader.batch_size, shuffle=isinstance(loader.sampler, RandomSampler),
+                      drop_last=loader.drop_last, num_workers=loader.num_workers)
@@ -0,0 +1,151 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Streaming replacement for the pd.read_csv + groupby(["Donor_ID","kmer_5"]).size().unstack()
+# step of kmer5_DataExploration.ipynb. The annotated mutation table is read in fixed-size chunks,
+# chunks are counted in a process pool with the k-mer contexts encoded as integers, and the
+# per-donor counts are accumulated in one (n_donors, 4^6) int32 array. Memory is bounded by the
+# chunk size times the number of chunks in flight, plus the count array.
+#
+# A context like AC[C>T]GA is coded from its 6 bases (2 left, ref, alt, 2 right) as a base-4 number.
+# Input can be the kmer5 TSV written by Scripts/kmer5_context.sh (kmer_5 column) or directly the
+# annotated table of Scripts/datamaf_pipeline.sh / src/data/maf_pipeline.py (kmer_11 + alt_allele columns,
+# TSV or Parquet).
+
+N_CODES = 4 ** 6
+BASES = 'ACGT'
+
+_lut = np.full(256, -1, dtype=np.int8)
+for _i, _b in enumerate(BASES):
+    _lut[ord(_b)] = _i
+    _lut[ord(_b.lower())] = _i
+_powers = 4 ** np.arange(5, -1, -1)
+
+
+def _encode_bases(bases):
+    """(n, 6) uint8 array of bases -> int codes, -1 if any base is not A/C/G/T"""
+    digits = _lut[bases].astype(np.int32)
+    codes = digits @ _powers
+    codes[(digits < 0).any(axis=1)] = -1
+    return codes
+
+
+def encode_kmer5(kmer5):
+    """encode an array of contexts in the kmer_5 format (e.g. AC[C>T]GA)"""
+    kmer5 = np.asarray(kmer5, dtype='S9').view(np.uint8).reshape(-1, 9)
+    return _encode_bases(kmer5[:, [0, 1, 3, 5, 7, 8]])
+
+
+def encode_kmer11(kmer11, alt_allele):
+    """encode from kmer_11 and alt_allele, with the same positions as Scripts/kmer5_context.sh"""
+    kmer11 = np.asarray(kmer11, dtype='S11').view(np.uint8).reshape(-1, 11)
+    alt = np.asarray(alt_allele, dtype='S1').view(np.uint8).reshape(-1, 1)
+    return _encode_bases(np.concatenate((kmer11[:, [1, 2, 5]], alt, kmer11[:, [6, 7]]), axis=1))
+
+
+def decode_kmer5(code):
+    """int code -> context name in the kmer_5 format"""
+    b = [BASES[(code // p) % 4] for p in _powers]
+    return f"{b[0]}{b[1]}[{b[2]}>{b[3]}]{b[4]}{b[5]}"
+
+
+def _count_chunk(chunk):
+    """counts of one chunk as sparse (donor, code, count) triplets over the donors of the chunk"""
+    if 'kmer_5' in chunk.columns:
+        codes = encode_kmer5(chunk['kmer_5'].to_numpy())
+    else:
+        codes = encode_kmer11(chunk['kmer_11'].to_numpy(), chunk['alt_allele'].to_numpy())
+    donors, first, donor_idx = np.unique(chunk['Donor_ID'].to_numpy(), return_index=True, return_inverse=True)
+    tumor_types = chunk['Tumor_Type'].to_numpy()[first]
+
+    keep = codes >= 0
+    keys, counts = np.unique(donor_idx[keep].astype(np.int64) * N_CODES + codes[keep], return_counts=True)
+    return donors, tumor_types, keys // N_CODES, keys % N_CODES, counts
+
+
+def count_contexts(path, chunksize=2_000_000, n_workers=None):
+    """
+    Stream a tab separated mutation table and count mutations per donor and context.
+
+    Args:
+        path: kmer5 TSV (kmer_5, Donor_ID, Tumor_Type) or annotated TSV/Parquet (kmer_11, alt_allele, Donor_ID, Tumor_Type)
+        chunksize: number of lines per chunk
+        n_workers: size of the process pool (default: number of cpus)
+
+    Returns:
+        counts (n_donors, N_CODES) int32 array, donor ids and tumor types in order of first appearance
+    """
+    n_workers = n_workers or os.cpu_count()
+    parquet = str(path).endswith('.parquet')
+    if parquet:
+        parquet_file = pq.ParquetFile(path)
+        header = parquet_file.schema_arrow.names
+    else:
+        header = pd.read_csv(path, sep='\t', nrows=0).columns
+    if 'kmer_5' in header:
+        usecols = ['kmer_5', 'Donor_ID', 'Tumor_Type']
+    else:
+        usecols = ['kmer_11', 'alt_allele', 'Donor_ID', 'Tumor_Type']
+    if parquet:
+        reader = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunksize, columns=usecols))
+    else:
+        reader = pd.read_csv(path, sep='\t', usecols=usecols, dtype=str, chunksize=chunksize)
+
+    donor_index = {}
+    tumor_types = []
+    counts = np.zeros((1024, N_CODES), dtype=np.int32)
+
+    def merge(result):
+        nonlocal counts
+        donors, types, rows, codes, chunk_counts = result
+        global_idx = np.empty(len(donors), dtype=np.int64)
+        for i, (donor, tumor_type) in enumerate(zip(donors, types)):
+            if donor not in donor_index:
+                donor_index[donor] = len(donor_index)
+                tumor_types.append(tumor_type)
+            global_idx[i] = donor_index[donor]
+        if len(donor_index) > len(counts): # grow the count array
+            counts = np.concatenate((counts, np.zeros((max(len(counts), len(donor_index) - len(counts)), N_CODES), dtype=np.int32)))
+        np.add.at(counts, (global_idx[rows], codes), chunk_counts.astype(np.int32))
+
+    # keep at most 2 chunks per worker in flight, so memory does not depend on the number of lines
+    with ProcessPoolExecutor(n_workers) as pool:
+        pending = deque()
+        for chunk in reader:
+            pending.append(pool.submit(_count_chunk, chunk))
+            if len(pending) >= 2 * n_workers:
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+
+    return counts[:len(donor_index)], np.array(list(donor_index), dtype=object), np.array(tumor_types, dtype=object)
+
+
+def count_frame(counts, donors, tumor_types, min_donors=20):
+    """
+    Dataframe in the layout of to_dgd.parquet: Donor_ID index (sorted), one column per observed
+    context (sorted by name, like unstack), Tumor_Type last, and only tumor types with >= min_donors donors.
+    """
+    observed = np.flatnonzero(counts.sum(axis=0))
+    names = np.array([decode_kmer5(code) for code in observed])
+    col_order = np.argsort(names)
+    row_order = np.argsort(donors)
+
+    df = pd.DataFrame(counts[np.ix_(row_order, observed[col_order])],
+                      index=pd.Index(donors[row_order], name='Donor_ID'),
+                      columns=names[col_order])
+    df['Tumor_Type'] = tumor_types[row_order]
+    n_per_type = df['Tumor_Type'].map(df['Tumor_Type'].value_counts())
+    return df[n_per_type >= min_donors]
+
+
+def write_to_dgd(path, out_path="to_dgd.parquet", min_donors=20, chunksize=2_000_000, n_workers=None):
+    """count contexts of the mutation table at path and write the DGD input parquet file"""
+    counts, donors, tumor_types = count_contexts(path, chunksize=chunksize, n_workers=n_workers)
+    df = count_frame(counts, donors, tumor_types, min_donors=min_donors)
+    df.to_parquet(out_path)
+    return df
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Python version of the FILTER -> ANNOTATE steps in Scripts/datamaf_pipeline.sh.
+# Instead of several awk passes, a disk sort and a join, the MAF is streamed twice:
+#   1. count how often every (Chromosome, Start_position, End_position) occurs among the kept SNVs (n_pc),
+#      with the positions packed into int64 keys and counted in a hash table
+#   2. filter, add n_pc/eid/kmer_11/alt_allele (pyrimidine strand-collapsed on byte arrays),
+#      hash-join the donor labels, and append the chunk as a row group to a Parquet file.
+# The columns match signature_snv_filtered_annotated4.tsv, so the file can go straight into
+# src/data/kmer_counts.py. Rows keep the MAF order instead of being sorted by sample id, and
+# project_code is kept (the shell version drops it in its final cut -f2-84).
+
+SIGNATURES = [
+    'SBS1_P', 'SBS2_P', 'SBS3_P', 'SBS4_P', 'SBS5_P', 'SBS6_S', 'SBS7a_S', 'SBS7b_S', 'SBS7c_S',
+    'SBS8_P', 'SBS9_P', 'SBS10a_S', 'SBS11_S', 'SBS12_P', 'SBS13_P', 'SBS14_S', 'SBS15_S', 'SBS16_P',
+    'SBS17a_P', 'SBS17b_P', 'SBS18_P', 'SBS19_P', 'SBS21_S', 'SBS22_P', 'SBS26_S', 'SBS28_P', 'SBS30_P',
+    'SBS33_P', 'SBS35_P', 'SBS36_P', 'SBS37_P', 'SBS38_S', 'SBS39_P', 'SBS40_P', 'SBS60_P', 'SBS55_S',
+    'SBS44_S', 'SBS61_S', 'SBS62_S', 'SBS63_S', 'SBS64_P', 'SBS65_S', 'SBS66_S', 'SBS67_S', 'SBS68_P',
+    'SBS69_P', 'SBS70_P', 'SBS71_P', 'SBS72_P', 'SBS73_S', 'SBS74_S', 'SBS75_S', 'SBS76_S', 'SBS77_P',
+    'SBS78_S', 'SBS79_S', 'SBS80_P', 'SBS81_P', 'SBS82_P', 'SBS83_P',
+]
+# columns of signature.sort.maf.bed (no header in the file)
+MAF_COLUMNS = [
+    'Chromosome', 'Start_position', 'End_position', 'Strand', 'Variant_Classification',
+    'Variant_Type', 'Reference_Allele', 'maja', 'Tumor_Seq_Allele2', 'snpOverlap',
+    'byFrequency', 'sample', 'normid', 'posAndType', 'ref_context', 'VAF',
+] + [f'BI_COMPOSITE_SNV_{s}' for s in SIGNATURES]
+# columns of PCAWG_donorinfo/donor_labels.tsv; sample ($4) is the join key
+DONOR_COLUMNS = ['Donor_ID', 'Tumor_Type', 'colcode', 'sample', 'project_code']
+OUT_COLUMNS = MAF_COLUMNS + ['n_pc', 'eid', 'kmer_11', 'alt_allele', 'Donor_ID', 'Tumor_Type', 'colcode', 'project_code']
+
+# same pattern as the awk filter (so e.g. 3*UTR matches any *UTR)
+NON_CODING = r"3*UTR|5*Flank|5*UTR|IGR|Intron|lincRNA|RNA"
+
+_complement = np.arange(256, dtype=np.uint8)
+for _a, _b in zip(b'ACGTacgt', b'TGCATGCA'):
+    _complement[_a] = _b
+_upper = np.arange(256, dtype=np.uint8)
+_upper[ord('a'):ord('z') + 1] -= 32
+
+
+def _read_maf(path, chunksize, usecols=None):
+    return pd.read_csv(path, sep='\t', header=None, names=MAF_COLUMNS, usecols=usecols,
+                       dtype=str, keep_default_na=False, chunksize=chunksize)
+
+
+def _keep(chunk):
+    """autosomal, non-protein-coding SNVs"""
+    return (
+        (chunk['Chromosome'] != 'chrX')
+        & (chunk['Chromosome'] != 'chrY')
+        & chunk['Variant_Classification'].str.contains(NON_CODING, regex=True)
+        & (chunk['Variant_Type'] == 'SNP')
+    )
+
+
+def _position_key(chunk, chrom_codes):
+    """
+    exact int64 key of (Chromosome, Start_position, End_position): chromosome code in the top bits,
+    then the start and the (small) end - start distance. chrom_codes is filled as new chromosomes show up.
+    """
+    codes, uniques = pd.factorize(chunk['Chromosome'])
+    lut = np.array([chrom_codes.setdefault(u, len(chrom_codes)) for u in uniques], dtype=np.int64)
+    start = chunk['Start_position'].to_numpy().astype(np.int64)
+    end = chunk['End_position'].to_numpy().astype(np.int64)
+    return (lut[codes] << 56) | (start << 16) | (end - start)
+
+
+def count_positions(maf_path, chunksize=2_000_000):
+    """
+    n_pc: number of kept SNVs at each (Chromosome, Start_position, End_position).
+    Returns the counts as a pandas Series (hash-indexed by position key) and the chromosome codes used for the keys.
+    """
+    usecols = ['Chromosome', 'Start_position', 'End_position', 'Variant_Classification', 'Variant_Type']
+    chrom_codes = {}
+    keys = [_position_key(chunk[_keep(chunk)], chrom_codes) for chunk in _read_maf(maf_path, chunksize, usecols)]
+    return pd.Series(np.concatenate(keys)).value_counts(), chrom_codes
+
+
+def strand_collapse(kmer_11, alt_allele):
+    """
+    Upper-case the 11-mers and alt alleles and take the reverse complement of those whose
+    center base is a purine, so every context has C or T in the middle.
+    Works on (n, 11) / (n, 1) byte arrays instead of per character.
+    """
+    kmer = _upper[np.asarray(kmer_11, dtype='S11').view(np.uint8).reshape(-1, 11)]
+    alt = _upper[np.asarray(alt_allele, dtype='S1').view(np.uint8).reshape(-1, 1)]
+    purine = (kmer[:, 5] != ord('C')) & (kmer[:, 5] != ord('T'))
+    kmer[purine] = _complement[kmer[purine, ::-1]]
+    alt[purine] = _complement[alt[purine]]
+    to_str = lambda a: a.copy().view(f'S{a.shape[1]}').ravel().astype(str)
+    return to_str(kmer), to_str(alt)
+
+
+def annotate_chunk(chunk, position_counts, chrom_codes, donor_labels):
+    """filter and annotate one chunk of the MAF, see module comment"""
+    chunk = chunk[_keep(chunk)].copy()
+    for col in ('snpOverlap', 'byFrequency'):
+        chunk.loc[chunk[col].str.strip() == '', col] = 'NA'
+
+    chunk['n_pc'] = position_counts.reindex(_position_key(chunk, chrom_codes)).to_numpy()
+    chunk['eid'] = chunk['Chromosome'].str[3:] + '_' + chunk['End_position']
+    chunk['kmer_11'], chunk['alt_allele'] = strand_collapse(
+        chunk['ref_context'].str[5:16].to_numpy(), chunk['Tumor_Seq_Allele2'].to_numpy()
+    )
+    # inner hash join on the sample id, like join -1 1 -2 1 on the sorted files
+    chunk = chunk.merge(donor_labels, on='sample', how='inner', sort=False)
+    return chunk[OUT_COLUMNS]
+
+
+def annotate_maf(maf_path, donor_labels_path, out_path="signature_snv_filtered_annotated.parquet", chunksize=2_000_000):
+    """
+    Run the whole filter/annotate/join stage and write the result as Parquet (one row group per chunk).
+
+    Args:
+        maf_path: signature.sort.maf.bed
+        donor_labels_path: PCAWG_donorinfo/donor_labels.tsv
+        out_path: output Parquet file
+        chunksize: number of MAF lines per chunk
+
+    Returns:
+        number of rows written
+    """
+    position_counts, chrom_codes = count_positions(maf_path, chunksize)
+    donor_labels = pd.read_csv(donor_labels_path, sep='\t', header=None, names=DONOR_COLUMNS,
+                               dtype=str, keep_default_na=False)
+
+    schema = pa.schema([(c, pa.int64() if c == 'n_pc' else pa.string()) for c in OUT_COLUMNS])
+    n_rows = 0
+    with pq.ParquetWriter(out_path, schema) as writer:
+        for chunk in _read_maf(maf_path, chunksize):
+            out = annotate_chunk(chunk, position_counts, chrom_codes, donor_labels)
+            writer.write_table(pa.Table.from_pandas(out, schema=schema, preserve_index=False))
+            n_rows += len(out)
+    return n_rows
@@ -2,6 +2,7 @@ import torch
 from torch.utils.data import Dataset
 import numpy as np
 import re
+import copy
 
 class FlattenedDataset(Dataset):
     def __init__(self, gtex, label_position=-1, scaling_type='mean'):
@@ -38,23 +39,79 @@ class FlattenedDataset(Dataset):
         else:
             raise ValueError("Invalid scaling_type")
 
-        # Precompute the flattened index map: one row per sample–mutation pair
-        self.flattened_indices = [
-            (sample_idx, mut_idx)
-            for sample_idx in range(self.num_samples)
-            for mut_idx in range(self.num_muts)
-        ]
+        # One row per sample–mutation pair. Row i is the pair divmod(i, num_muts), so no index map is stored.
+        # Views (subset, shuffled, per tumor type) instead keep their flat indices in a compact int array.
+        self.row_index = None
 
     def __len__(self):
-        # Total number of sample–mutation pairs
-        return len(self.flattened_indices)
+        # Total number of sample–mutation pairs (in this view)
+        if self.row_index is None:
+            return self.num_samples * self.num_muts
+        return len(self.row_index)
 
     def __getitem__(self, idx):
-        sample_idx, mut_idx = self.flattened_indices[idx] # idx are the indices for the current batch
+        if not isinstance(idx, (int, np.integer)):
+            return self.get_batch(idx)
+        if self.row_index is not None:
+            idx = int(self.row_index[idx])
+        sample_idx, mut_idx = divmod(idx, self.num_muts) # idx are the indices for the current batch
         value = self.mut_matrix[sample_idx, mut_idx].unsqueeze(0)
 
         # Use precomputed lib
         lib = self.lib_values[sample_idx]
         
 
-        return value, lib, sample_idx, mut_idx 
\ No newline at end of file
+        return value, lib, sample_idx, mut_idx
+
+    def _view(self, flat_idx):
+        """shallow copy of the dataset that shares all tensors but iterates over flat_idx only"""
+        flat_idx = torch.as_tensor(flat_idx).long()
+        if self.row_index is not None:
+            flat_idx = self.row_index[flat_idx].long()
+        view = copy.copy(self)
+        dtype = torch.int32 if self.num_samples * self.num_muts < 2**31 else torch.int64
+        view.row_index = flat_idx.to(dtype)
+        return view
+
+    def subset(self, idx):
+        """view over the rows idx (positions in this dataset, as passed to __getitem__)"""
+        return self._view(idx)
+
+    def shuffled(self, generator=None):
+        """view over all rows of this dataset in a random order"""
+        return self._view(torch.randperm(len(self), generator=generator))
+
+    def sample_view(self, sample_ids):
+        """view over all rows belonging to the given samples. sample_idx keeps pointing into the full dataset."""
+        sample_ids = torch.as_tensor(sample_ids).long()
+        if self.row_index is not None:
+            # keep only the rows that are part of this view, in the view's order:
+            # a mask over the samples, looked up per row, so memory scales with the view and not num_samples * num_muts
+            keep = torch.zeros(self.num_samples, dtype=torch.bool)
+            keep[sample_ids] = True
+            view_samples = torch.div(self.row_index.long(), self.num_muts, rounding_mode='floor')
+            return self._view(torch.nonzero(keep[view_samples]).squeeze(1))
+        flat_idx = (sample_ids.unsqueeze(1) * self.num_muts + torch.arange(self.num_muts)).flatten()
+        return self._view(flat_idx)
+
+    def tumor_type_view(self, tumor_types):
+        """view over all rows of samples with the given tumor type label(s)"""
+        mask = np.isin(self.labels, np.atleast_1d(tumor_types))
+        return self.sample_view(np.flatnonzero(mask))
+
+    def get_batch(self, idx):
+        """
+        Batched version of __getitem__. Takes a list/array/tensor of flat indices and
+        returns the same four outputs as a collated DataLoader batch, each built with one gather.
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        if self.row_index is not None:
+            idx = self.row_index[idx].long()
+        # flat indices are ordered sample-major, so the pair can be recovered arithmetically
+        sample_idx = torch.div(idx, self.num_muts, rounding_mode='floor')
+        mut_idx = idx % self.num_muts
+
+        value = self.mut_matrix[sample_idx, mut_idx].unsqueeze(1)
+        lib = self.lib_values[sample_idx]
+
+        return value, lib, sample_idx, mut_idx
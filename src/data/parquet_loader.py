@@ -0,0 +1,127 @@
+import numpy as np
+import pyarrow.parquet as pq
+from sklearn.model_selection import train_test_split
+
+from src.data.flat_dataset import FlattenedDataset
+
+# Reads to_dgd.parquet into a single compact numpy buffer and builds the train/validation/test
+# FlattenedDatasets as zero-copy row slices of it, instead of
+# read_parquet -> train_test_split on dataframes -> .drop().values -> torch.tensor.
+# Peak memory is one copy of the count matrix plus one block of columns.
+
+def _index_columns(parquet_file):
+    """names of the stored pandas index column(s), e.g. Donor_ID"""
+    metadata = parquet_file.schema_arrow.pandas_metadata or {}
+    return [c for c in metadata.get('index_columns', []) if isinstance(c, str)]
+
+
+def split_indices(labels, test_size=0.3, val_size=0.5, seed=1):
+    """
+    Stratified train/validation/test split on row indices. Gives the same rows as the notebooks'
+    train_test_split(mut_data, test_size=0.3, ...) followed by train_test_split(val_test_data, test_size=0.5, ...)
+    """
+    labels = np.asarray(labels)
+    train_idx, val_test_idx = train_test_split(np.arange(len(labels)), test_size=test_size, random_state=seed, stratify=labels)
+    val_idx, test_idx = train_test_split(val_test_idx, test_size=val_size, random_state=seed, stratify=labels[val_test_idx])
+    return {'train': train_idx, 'validation': val_idx, 'test': test_idx}
+
+
+def read_count_matrix(path, label_column='Tumor_Type', row_order=None, dtype=np.float32, block_size=64):
+    """
+    Read the count matrix of a parquet file (one row per donor, one column per mutation context)
+    into a C-contiguous numpy array of the given dtype.
+
+    Args:
+        path: parquet file, e.g. to_dgd.parquet
+        label_column: name of the class label column, which is kept out of the matrix
+        row_order: optional array of row indices; the buffer is filled in this order, so that
+            e.g. the concatenated split indices end up as contiguous row blocks
+        dtype: dtype of the buffer (float32 is what the model uses)
+        block_size: number of columns decoded at a time
+
+    Returns:
+        matrix, labels, kmer_names, sample_ids (all in row_order)
+    """
+    parquet_file = pq.ParquetFile(path)
+    index_columns = _index_columns(parquet_file)
+    kmer_names = [name for name in parquet_file.schema_arrow.names if name != label_column and name not in index_columns]
+
+    # only the label and index columns are read as whole columns up front
+    labels = parquet_file.read(columns=[label_column]).column(0).to_numpy()
+    sample_ids = None
+    if index_columns:
+        sample_ids = parquet_file.read(columns=index_columns[:1]).column(0).to_numpy()
+    if row_order is None:
+        row_order = np.arange(len(labels))
+    else:
+        row_order = np.asarray(row_order)
+        labels = labels[row_order]
+        if sample_ids is not None:
+            sample_ids = sample_ids[row_order]
+
+    matrix = np.empty((len(row_order), len(kmer_names)), dtype=dtype)
+    for start in range(0, len(kmer_names), block_size):
+        block = parquet_file.read(columns=kmer_names[start:start + block_size])
+        for j in range(block.num_columns):
+            # primitive columns without nulls are exposed without a copy; the cast happens while filling the buffer
+            matrix[:, start + j] = block.column(j).to_numpy()[row_order]
+        del block
+
+    return matrix, labels, kmer_names, sample_ids
+
+
+SPLIT_NAMES = ['train', 'validation', 'test']
+
+
+def read_split_matrix(path, label_column='Tumor_Type', test_size=0.3, val_size=0.5, seed=1, dtype=np.float32):
+    """
+    Split the rows of a parquet count matrix (see split_indices) and read the matrix once,
+    with the rows ordered train | validation | test, so every split is a contiguous row block.
+
+    Returns:
+        matrix, labels, kmer_names, sample_ids (in split order) and dict with the original row indices of each split
+    """
+    parquet_file = pq.ParquetFile(path)
+    labels = parquet_file.read(columns=[label_column]).column(0).to_numpy()
+    splits = split_indices(labels, test_size=test_size, val_size=val_size, seed=seed)
+    del parquet_file, labels
+
+    matrix, labels, kmer_names, sample_ids = read_count_matrix(
+        path, label_column=label_column, row_order=np.concatenate([splits[name] for name in SPLIT_NAMES]), dtype=dtype
+    )
+    return matrix, labels, kmer_names, sample_ids, splits
+
+
+def split_datasets(matrix, labels, kmer_names, sample_ids, splits, precomputed=None, **dataset_kwargs):
+    """
+    FlattenedDatasets wrapping the row blocks of a matrix in split order (no copy).
+    precomputed can hold per split keyword arguments for FlattenedDataset.from_arrays (e.g. lib_values).
+    """
+    datasets = {}
+    start = 0
+    for name in SPLIT_NAMES:
+        stop = start + len(splits[name])
+        datasets[name] = FlattenedDataset.from_arrays(
+            matrix[start:stop], # a view into the shared buffer
+            labels[start:stop],
+            kmer_names,
+            sample_ids=None if sample_ids is None else sample_ids[start:stop],
+            **(precomputed or {}).get(name, {}),
+            **dataset_kwargs
+        )
+        start = stop
+    return datasets
+
+
+def load_flattened_splits(path, label_column='Tumor_Type', test_size=0.3, val_size=0.5, seed=1, dtype=np.float32, **dataset_kwargs):
+    """
+    Create the train, validation and test FlattenedDatasets straight from a parquet file.
+    The matrix is read once, with the rows ordered train | validation | test, and each dataset
+    wraps its row block with torch.from_numpy (no copy). Extra kwargs go to FlattenedDataset
+    (e.g. scaling_type, return_onehot).
+
+    Returns:
+        dict with the datasets ('train', 'validation', 'test') and dict with the original row indices of each split
+    """
+    *arrays, splits = read_split_matrix(path, label_column, test_size, val_size, seed, dtype)
+    return split_datasets(*arrays, splits, **dataset_kwargs), splits
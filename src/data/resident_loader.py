@@ -0,0 +1,98 @@
+import copy
+import torch
+
+class ResidentLoader:
+    """
+    Device-resident replacement for a DataLoader over a FlattenedDataset.
+
+    The count matrix, lib sizes and (if used) context encodings are moved to the target
+    device once. Every epoch a permutation of the rows is drawn with torch.randperm on that
+    device, and batches are built by slicing the permutation and gathering from the resident
+    tensors, so there are no workers, no collation and no per-batch host->device copies.
+    Batches have the same layout as the DataLoader ones (value, lib, sample_idx, mut_idx[, onehot]),
+    and .dataset points to the wrapped dataset, so it can be passed wherever a
+    train/validation/test loader is expected (train_dgd, learn_new_representation).
+
+    Attributes
+    ----------
+    dataset: FlattenedDataset
+        the wrapped dataset (can also be a view, see FlattenedDataset.subset)
+    batch_size: int
+        number of flattened rows per batch
+    shuffle: bool
+        draw a new random row order every epoch
+    device: torch.device
+        device all tensors and batches live on
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=False, device=None, drop_last=False, generator=None):
+        """Args:
+        dataset: FlattenedDataset (with or without onehot)
+        batch_size: number of flattened rows per batch
+        shuffle: if True a new permutation is drawn every epoch
+        device: target device, defaults to cuda if available
+        drop_last: drop the last incomplete batch
+        generator: optional torch.Generator on the target device for reproducible shuffling
+        """
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = torch.device(device)
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+        self.num_muts = dataset.num_muts
+        self.mut_matrix = dataset.mut_matrix.to(self.device)
+        self.lib_values = dataset.lib_values.to(self.device)
+        if getattr(dataset, "return_onehot", False):
+            self.context_matrix = dataset.context_matrix.to(self.device)
+        else:
+            self.context_matrix = None
+        if dataset.row_index is not None:
+            self.row_index = dataset.row_index.to(self.device).long()
+        else:
+            self.row_index = None
+
+    def sample_view(self, sample_ids):
+        """loader over all rows of the given samples (see FlattenedDataset.sample_view), sharing the resident tensors"""
+        view = copy.copy(self)
+        view.dataset = self.dataset.sample_view(torch.as_tensor(sample_ids).cpu())
+        view.row_index = view.dataset.row_index.to(self.device).long()
+        return view
+
+    def without_onehot(self):
+        """loader over the same rows that yields no onehot (see flat_dataset.without_onehot), sharing the resident tensors"""
+        view = copy.copy(self)
+        view.dataset = copy.copy(self.dataset)
+        view.dataset.return_onehot = False
+        view.context_matrix = None
+        return view
+
+    def __len__(self):
+        # number of batches per epoch
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n_rows = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(n_rows, device=self.device, generator=self.generator)
+        else:
+            order = torch.arange(n_rows, device=self.device)
+        if self.row_index is not None:
+            order = self.row_index[order]
+
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            idx = order[start:start + self.batch_size] # a view, no copy
+            sample_idx = torch.div(idx, self.num_muts, rounding_mode='floor')
+            mut_idx = idx % self.num_muts
+
+            value = self.mut_matrix[sample_idx, mut_idx].unsqueeze(1)
+            lib = self.lib_values[sample_idx]
+            if self.context_matrix is None:
+                yield value, lib, sample_idx, mut_idx
+            else:
+                yield value, lib, sample_idx, mut_idx, self.context_matrix[mut_idx]
@@ -0,0 +1,190 @@
+import torch
+from torch.utils.data import Dataset, Sampler
+import numpy as np
+import re
+
+from src.data.flat_dataset import build_context_matrix
+
+class SparseFlattenedDataset(Dataset):
+    '''
+    CSR-backed variant of FlattenedDataset for sparse sample x mutation-context count matrices.
+
+    Only the non-zero counts are stored (crow/col/values per sample row). Instead of visiting
+    every cell, an epoch consists of all non-zero cells plus a random subsample of the zero cells
+    (zero_fraction of them, drawn uniformly with replacement). Every row carries a weight: 1 for
+    non-zero cells and n_zero / n_sampled_zero for the sampled zeros, so the weighted sum of the NB
+    log-likelihoods (Decoder.log_prob(..., weight=...)) is an unbiased estimate of the full sum.
+    A new zero subsample is drawn with resample(), which ZeroAwareBatchSampler does every epoch.
+
+    Batches are (value, lib, sample_idx, mut_idx, onehot, weight), or without onehot if
+    return_onehot is False.
+    '''
+    def __init__(self, gtex, label_position=-1, scaling_type='mean', zero_fraction=0.1, return_onehot=True, seed=None):
+        '''
+        Args:
+            gtex: pandas dataframe containing the counts and the class labels
+            label_position: column id of the class labels
+            scaling_type: 'mean', 'max' or 'sum' lib size
+            zero_fraction: fraction of the zero cells visited per epoch (1 visits all of them, exactly like the dense dataset)
+            return_onehot: also return the onehot encoded mutation context
+            seed: seed for the zero subsampling
+        '''
+        counts = gtex.drop(gtex.columns[[label_position]], axis=1)
+        rows, cols = np.nonzero(counts.values)
+        crow = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=counts.shape[0]))))
+        self._setup(
+            torch.from_numpy(crow),
+            torch.from_numpy(cols),
+            torch.tensor(counts.values[rows, cols]),
+            gtex.iloc[:, label_position].values,
+            counts.columns.tolist(),
+            scaling_type, zero_fraction, return_onehot, seed,
+        )
+
+    @classmethod
+    def from_csr(cls, crow, col, values, labels, kmer_names, scaling_type='mean', zero_fraction=0.1, return_onehot=True, seed=None):
+        '''
+        Build the dataset directly from CSR arrays (e.g. scipy.sparse.csr_matrix indptr/indices/data),
+        without ever holding the dense matrix.
+        '''
+        dataset = cls.__new__(cls)
+        dataset._setup(torch.as_tensor(crow), torch.as_tensor(col), torch.as_tensor(values),
+                       np.asarray(labels), list(kmer_names), scaling_type, zero_fraction, return_onehot, seed)
+        return dataset
+
+    def _setup(self, crow, col, values, labels, kmer_names, scaling_type, zero_fraction, return_onehot, seed):
+        self.scaling_type = scaling_type
+        self.zero_fraction = zero_fraction
+        self.return_onehot = return_onehot
+        self.labels = labels
+        self.kmer_names = kmer_names
+
+        # Extract mutation labels
+        self.mut_labels = []
+        for kmer in self.kmer_names:
+            # Extract mutation label from format like [C>T]
+            match = re.search(r'\[([ACGT]>[ACGT])\]', kmer.upper())
+            mut_label = f"[{match.group(1)}]" if match else "[UNK]"
+            self.mut_labels.append(mut_label)
+
+        self.num_samples = len(crow) - 1
+        self.num_muts = len(kmer_names)
+        self.crow = crow.long()
+        self.col = col.int()
+        self.values = values.float()
+        self.nnz = len(self.values)
+
+        # sorted flat index (sample_idx * num_muts + mut_idx) of every non-zero cell
+        nz_rows = torch.repeat_interleave(torch.arange(self.num_samples), self.crow.diff())
+        self.nz_flat = nz_rows * self.num_muts + self.col.long()
+
+        # Precompute lib sizes
+        if self.scaling_type == 'mean':
+            self.lib_values = torch.zeros(self.num_samples).index_add_(0, nz_rows, self.values).div_(self.num_muts)
+        elif self.scaling_type == 'max':
+            self.lib_values = torch.zeros(self.num_samples).scatter_reduce_(0, nz_rows, self.values, reduce='amax')
+        elif self.scaling_type == 'sum':
+            self.lib_values = torch.zeros(self.num_samples).index_add_(0, nz_rows, self.values)
+        else:
+            raise ValueError("Invalid scaling_type")
+        self.lib_values = self.lib_values.unsqueeze(1)
+
+        self.context_matrix = build_context_matrix(self.kmer_names)
+
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.resample()
+
+    @property
+    def density(self):
+        return self.nnz / (self.num_samples * self.num_muts)
+
+    def to_dense(self):
+        """dense (num_samples, num_muts) count matrix, e.g. for plotting"""
+        dense = torch.zeros(self.num_samples * self.num_muts)
+        dense[self.nz_flat] = self.values
+        return dense.view(self.num_samples, self.num_muts)
+
+    def _sample_zeros(self, n_draw):
+        """draw n_draw zero cells uniformly with replacement by rejecting draws that hit a non-zero cell"""
+        n_cells = self.num_samples * self.num_muts
+        zeros = torch.empty(0, dtype=torch.long)
+        while len(zeros) < n_draw:
+            n_missing = n_draw - len(zeros)
+            cand = torch.randint(n_cells, (int(n_missing / max(1 - self.density, 1e-3)) + 16,), generator=self.generator)
+            if self.nnz > 0:
+                pos = torch.searchsorted(self.nz_flat, cand).clamp_(max=self.nnz - 1)
+                cand = cand[self.nz_flat[pos] != cand]
+            zeros = torch.cat((zeros, cand[:n_missing]))
+        return zeros
+
+    def resample(self):
+        """draw a new subsample of zero cells and rebuild the rows (and weights) of the epoch"""
+        n_zero = self.num_samples * self.num_muts - self.nnz
+        if self.zero_fraction >= 1:
+            # all zero cells, exactly once
+            is_zero = torch.ones(self.num_samples * self.num_muts, dtype=torch.bool)
+            is_zero[self.nz_flat] = False
+            zeros = torch.nonzero(is_zero).squeeze(1)
+            zero_weight = 1.
+        else:
+            n_draw = int(round(self.zero_fraction * n_zero))
+            zeros = self._sample_zeros(n_draw)
+            zero_weight = n_zero / n_draw if n_draw > 0 else 0.
+
+        self.epoch_flat = torch.cat((self.nz_flat, zeros))
+        self.epoch_values = torch.cat((self.values, torch.zeros(len(zeros))))
+        self.epoch_weights = torch.cat((torch.ones(self.nnz), torch.full((len(zeros),), zero_weight)))
+
+    def __len__(self):
+        # number of rows in the current epoch (non-zero cells + sampled zero cells)
+        return len(self.epoch_flat)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            idx = [idx]
+            return tuple(x[0] for x in self.get_batch(idx))
+        return self.get_batch(idx)
+
+    def get_batch(self, idx):
+        """gathers a batch of epoch rows, see FlattenedDataset.get_batch"""
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        flat = self.epoch_flat[idx]
+        sample_idx = torch.div(flat, self.num_muts, rounding_mode='floor')
+        mut_idx = flat % self.num_muts
+
+        value = self.epoch_values[idx].unsqueeze(1)
+        lib = self.lib_values[sample_idx]
+        weight = self.epoch_weights[idx].unsqueeze(1)
+
+        if not self.return_onehot:
+            return value, lib, sample_idx, mut_idx, weight
+        return value, lib, sample_idx, mut_idx, self.context_matrix[mut_idx], weight
+
+
+class ZeroAwareBatchSampler(Sampler):
+    """
+    Batch sampler for SparseFlattenedDataset that draws a new zero subsample at the start of every epoch.
+    Use with DataLoader(dataset, sampler=ZeroAwareBatchSampler(dataset, batch_size), batch_size=None).
+    The dataset is resampled in the main process, so keep num_workers=0.
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        self.dataset.resample()
+        if self.shuffle:
+            order = torch.randperm(len(self.dataset), generator=self.dataset.generator)
+        else:
+            order = torch.arange(len(self.dataset))
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            yield order[start:start + self.batch_size]
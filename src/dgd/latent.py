@@ -83,6 +83,82 @@ class RepresentationLayer(torch.nn.Module):
             Value initialization: {self._value_init}
         """
 
+class SparseRepresentationLayer(RepresentationLayer):
+    """
+    RepresentationLayer whose indexed forward pass produces sparse gradients.
+
+    The representations are gathered with an embedding lookup (sparse=True), so the gradient of z
+    only holds the rows of the batch instead of a dense (n_sample, n_rep) tensor.
+    Use it with an optimizer that accepts sparse gradients and updates only those rows,
+    e.g. src.dgd.optim.RowAdamW (torch.optim.AdamW does not accept sparse gradients).
+
+    Methods
+    ----------
+    forward(idx=None)
+        takes sample index and returns corresponding representation (sparse gradient);
+        without index the full tensor is returned (dense gradient)
+    """
+
+    def forward(self, idx=None):
+        """
+        Forward pass returns indexed representations
+        """
+        if idx is None:
+            return self.z
+        idx = torch.as_tensor(idx, device=self.z.device)
+        return torch.nn.functional.embedding(idx, self.z, sparse=True)
+
+    def __str__(self):
+        return super().__str__().replace("RepresentationLayer:", "SparseRepresentationLayer:")
+
+class ContextEncoding(torch.nn.Module):
+    """
+    Fixed (not learnable) encoding of the mutation contexts, e.g. the one-hot k-mers.
+
+    The full (n_mut, n_enc) table is kept as a buffer, so it follows the model to its device
+    and is saved with it. The data loader then only has to ship integer mut_idx, and the
+    encodings are gathered on the device inside the forward path, like RepresentationLayer does
+    for the representations.
+
+    Attributes
+    ----------
+    n_mut: int
+        number of mutation contexts (has to match corresponding dataset)
+    n_enc: int
+        length of the encoding of one context (4k for one-hot k-mers)
+    table: torch.Tensor
+        buffer with the encodings of shape (n_mut,n_enc), row i belonging to mut_idx i
+
+    Methods
+    ----------
+    forward(idx=None)
+        takes mutation index and returns corresponding encoding
+    """
+
+    def __init__(self, table):
+        """Args:
+        table: tensor of shape (n_mut, n_enc), e.g. FlattenedDataset.context_matrix
+        """
+        super(ContextEncoding, self).__init__()
+        table = torch.as_tensor(table, dtype=torch.float32)
+        self.n_mut, self.n_enc = table.shape
+        self.register_buffer("table", table)
+
+    def forward(self, idx=None):
+        """
+        Forward pass returns indexed encodings (on the device of the table)
+        """
+        if idx is None:
+            return self.table
+        return self.table[torch.as_tensor(idx, device=self.table.device)]
+
+    def __str__(self):
+        return f"""
+        ContextEncoding:
+            Number of contexts: {self.n_mut}
+            Encoding length: {self.n_enc}
+        """
+
 class gaussian:
     """
     This is a simple Gaussian prior used for initializing mixture model means
@@ -188,6 +264,19 @@ class softball:
             1 + torch.exp(self.sharpness * (z.norm(dim=-1) / self.radius - 1))
         )
 
+class _CachedPrior(torch.autograd.Function):
+    """returns a cached prior value and passes its cached parameter gradients on in backward"""
+
+    @staticmethod
+    def forward(ctx, value, grads, *params):
+        ctx.grads = grads
+        return value.clone()
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        return (None, None) + tuple(None if g is None else grad_output * g for g in ctx.grads)
+
 class GaussianMixture(nn.Module):
     """
     A mixture of multi-variate Gaussians.
@@ -234,8 +323,18 @@ class GaussianMixture(nn.Module):
     component_sample(n_sample)
         creates n_sample new samples PER mixture component
     sample_probs(x)
-        computes log-probs per sample (not summed and not including priors)
-    sample_new_points(n_points, option='random', n_new=1)
+        computes probs per sample and component (not summed and not including priors)
+    sample_log_probs(x, chunk_size=65536)
+        the same in log-space, computed in chunks
+    iter_log_probs(x, chunk_size=65536)
+        streams the per-component log-probs chunk by chunk
+    responsibilities(x, chunk_size=65536, log=False)
+        normalized (log-)probabilities of the components per sample
+    clustering(x, chunk_size=65536)
+        most probable component per sample
+    em_update(x, n_iter=1, chunk_size=65536)
+        closed-form MAP update of means, log-variances and weights from representations x
+    sample_new_points(resample_type='mean', n_new_samples=1)
         creating new samples either like in component_sample or from component means
     reshape_targets(y, y_type='true')
         reshaping targets (true counts) to be comparable to model outputs
@@ -244,8 +343,12 @@ class GaussianMixture(nn.Module):
         reducing new representations to 1 per sample (based on lowest loss)
     choose_old_or_new(z_new, loss_new, z_old, loss_old)
         selecting best representation per sample between tow representation tensors (pairwise)
+    set_prior_cache(enabled=True)
+        reuse the prior term (and its gradients) between parameter updates, see _prior_term
     """
 
+    cache_prior = False # see set_prior_cache (class default, so pickled models load unchanged)
+
     def __init__(
         self,
         n_mix_comp: int,
@@ -372,20 +475,62 @@ class GaussianMixture(nn.Module):
         """
 
         # y = logp = - 0.5k*log(2pi) -(0.5*(x-mean[i])^2)/variance - 0.5k*log(variance)
-        # sum terms for each component (sum is over last dimension)
-        # x is unsqueezed to (n_sample,1,dim), so broadcasting of mean (n_mix_comp,dim) works
-        # x = x.to(device) # added
+        # evaluated for all components at once, see _component_log_prob
         x = x.to(self.mean.device)
-        y = -(x.unsqueeze(-2) - self.mean).square().div(2 * self.covariance).sum(-1).to(self.mean.device)
-        y = y - self._log_var_factor * self.log_var.sum(-1)
-        y = y + self._pi_term
-        # For each component multiply by mixture probs
-        y = y + torch.log_softmax(self.weight, dim=0)
+        y = self._component_log_prob(x)
         y = torch.logsumexp(y, dim=-1)
-        y = y + self._prior_log_prob()  # += gives cuda error
+        y = y + self._prior_term()  # += gives cuda error
 
         return -y  # returning negative log probability density
 
+    def _scoring_terms(self):
+        """
+        Per-component terms of the log density, computed once per parameter update:
+        precision 1/variance (n_mix_comp, 1 or dim), mean * precision (n_mix_comp, dim) and
+        the constant (n_mix_comp) collecting -0.5*mean^2*precision, the log-variance and pi terms and the log mixture weights.
+        Without gradients (evaluation, clustering, sampling) they are cached until a parameter changes
+        (tracked by the parameters' _version counters); with gradients they are rebuilt every call, so each
+        forward has its own graph. Terms computed under inference_mode are inference tensors, which cannot
+        be saved for backward (e.g. frozen GMM parameters but a representation x that requires grad), so
+        they are kept apart from the ones computed outside it.
+        """
+        params = (self.mean, self.log_var, self.weight)
+        key = tuple(p._version for p in params) + (self.mean.device, torch.is_inference_mode_enabled())
+        cache = self.__dict__.get("_scoring_cache")
+        grad = torch.is_grad_enabled() and any(p.requires_grad for p in params)
+        if not grad and cache is not None and cache[0] == key:
+            return cache[1]
+
+        precision = torch.exp(-self.log_var)
+        mean_precision = self.mean * precision
+        const = (
+            -0.5 * (self.mean * mean_precision).sum(-1)
+            - self._log_var_factor * self.log_var.sum(-1)
+            + self._pi_term
+            + torch.log_softmax(self.weight, dim=0)
+        )
+        terms = (precision, mean_precision, const)
+        if grad:
+            self._scoring_cache = None
+        else:
+            self._scoring_cache = (key, terms)
+        return terms
+
+    def _component_log_prob(self, x):
+        """
+        log(mixture weight * component density) of every sample under every component, shape (n_sample, n_mix_comp).
+        The quadratic form is expanded as -0.5*x^2 @ precision^T + x @ (mean*precision)^T - 0.5*mean^2*precision,
+        so only (n_sample, dim) and (n_sample, n_mix_comp) tensors are created.
+        """
+        precision, mean_precision, const = self._scoring_terms()
+        if precision.shape[-1] == 1:
+            # fixed / isotropic: one precision per component
+            y = -0.5 * x.square().sum(-1, keepdim=True) * precision.T
+        else:
+            y = -0.5 * (x.square() @ precision.T)
+        y = y + x @ mean_precision.T
+        return y + const
+
     def _prior_log_prob(self):
         """Calculate log prob of prior on mean, log_var, and mixture coefficients"""
         # Mixture weights
@@ -401,6 +546,58 @@ class GaussianMixture(nn.Module):
             )  # ensuring correct approximation
         return p
 
+    def set_prior_cache(self, enabled=True):
+        """
+        Reuse the prior term and its parameter gradients between parameter updates (_cached_prior_log_prob).
+        Only worth it if the GMM parameters change less often than once per minibatch, e.g. with gradient
+        accumulation over several batches. With an optimizer step after every minibatch (train_dgd) every batch
+        is a cache miss, which costs an extra autograd.grad, so keep it off there.
+        """
+        self.cache_prior = enabled
+        return self
+
+    def _prior_term(self):
+        """
+        The prior term of forward(): recomputed every call while gradients flow into the parameters
+        (training with a GMM step per minibatch), cached when no gradient is needed (eval, clustering,
+        test time with frozen GMM parameters) or when enabled with set_prior_cache.
+        """
+        params = (self.mean, self.log_var, self.weight)
+        needs_grad = torch.is_grad_enabled() and any(p.requires_grad for p in params)
+        if needs_grad and not self.cache_prior:
+            return self._prior_log_prob()
+        return self._cached_prior_log_prob()
+
+    def _cached_prior_log_prob(self):
+        """
+        _prior_log_prob(), evaluated once per parameter update instead of once per minibatch.
+        The value and its gradients w.r.t. the parameters are cached until one of the parameters' _version
+        counters (bumped by every optimizer step, load_state_dict or em_update), requires_grad flags or device change.
+        Every call returns a new autograd node (_CachedPrior) that feeds the cached gradients into the
+        parameters, so each minibatch's backward gets the same gradient as with the uncached prior.
+        """
+        params = (self.mean, self.log_var, self.weight)
+        key = tuple(p._version for p in params) + tuple(p.requires_grad for p in params) + (self.mean.device,)
+        grad_enabled = torch.is_grad_enabled() and not torch.is_inference_mode_enabled()
+        cache = self.__dict__.get("_prior_cache")
+        # an entry computed without autograd (no_grad, inference_mode) has no gradients and is recomputed when they are needed
+        if cache is None or cache[0] != key or (grad_enabled and not cache[2]):
+            with torch.enable_grad():
+                value = self._prior_log_prob()
+            needs_grad = [p for p in params if p.requires_grad]
+            if grad_enabled and torch.is_tensor(value) and value.requires_grad:
+                grads = iter(torch.autograd.grad(value, needs_grad, allow_unused=True))
+                grads = tuple(next(grads) if p.requires_grad else None for p in params)
+            else:
+                grads = (None,) * len(params)
+            value = torch.as_tensor(value, dtype=self.mean.dtype, device=self.mean.device).detach()
+            self._prior_cache = (key, (value, grads), grad_enabled)
+            cache = self._prior_cache
+        value, grads = cache[1]
+        if not grad_enabled:
+            return value
+        return _CachedPrior.apply(value, grads, *params)
+
     def log_prob(self, x):
         """return the log density of the probability of z being drawn from the mixture model"""
         return -self.forward(x)
@@ -418,32 +615,47 @@ class GaussianMixture(nn.Module):
     def stddev(self):
         return torch.sqrt(self.covariance)
 
+    def _sampling_params(self):
+        """
+        detached mixture probabilities (n_mix_comp) and standard deviations (n_mix_comp, dim) on the parameter device,
+        cached until a parameter changes (tracked by the parameters' _version counters, like _scoring_terms,
+        and likewise kept apart for inference_mode)
+        """
+        key = tuple(p._version for p in (self.mean, self.log_var, self.weight)) + (self.mean.device, torch.is_inference_mode_enabled())
+        cache = self.__dict__.get("_sampling_cache")
+        if cache is None or cache[0] != key:
+            with torch.no_grad():
+                probs = torch.softmax(self.weight, dim=-1)
+                stddev = torch.exp(0.5 * self.log_var).expand(self.n_mix_comp, self.dim).contiguous()
+            self._sampling_cache = (key, (probs, stddev))
+            cache = self._sampling_cache
+        return cache[1]
+
     def _Distribution(self):
         """create a distribution from mixture model (for sampling)"""
-        with torch.no_grad():
-            mix = D.Categorical(probs=torch.softmax(self.weight, dim=-1))
-            comp = D.Independent(D.Normal(self.mean, self.stddev), 1)
-            return D.MixtureSameFamily(mix, comp)
+        probs, stddev = self._sampling_params()
+        mix = D.Categorical(probs=probs)
+        comp = D.Independent(D.Normal(self.mean.detach(), stddev), 1)
+        return D.MixtureSameFamily(mix, comp)
 
-    def sample(self, n_sample):
-        """create samples from the GMM distribution"""
+    def sample(self, n_sample, generator=None):
+        """create samples from the GMM distribution (on the parameter device)"""
         with torch.no_grad():
-            gmm = self._Distribution()
-            return gmm.sample(torch.tensor([n_sample]))
+            probs, stddev = self._sampling_params()
+            comp = torch.multinomial(probs, n_sample, replacement=True, generator=generator)
+            noise = torch.randn((n_sample, self.dim), device=self.mean.device, generator=generator)
+            return self.mean[comp] + noise * stddev[comp]
 
-    def component_sample(self, n_sample):
-        """Returns a sample from each component. Tensor shape (n_sample,n_mix_comp,dim)"""
+    def component_sample(self, n_sample, generator=None):
+        """Returns a sample from each component (on the parameter device). Tensor shape (n_sample,n_mix_comp,dim)"""
         with torch.no_grad():
-            comp = D.Independent(D.Normal(self.mean, self.stddev), 1)
-            return comp.sample(torch.tensor([n_sample]))
+            _, stddev = self._sampling_params()
+            noise = torch.randn((n_sample, self.n_mix_comp, self.dim), device=self.mean.device, generator=generator)
+            return self.mean + noise * stddev
 
     def sample_probs(self, x):
         """compute probability densities per sample without prior. returns tensor of shape (n_sample, n_mix_comp)"""
-        y = -(x.unsqueeze(-2) - self.mean).square().div(2 * self.covariance).sum(-1)
-        y = y - self._log_var_factor * self.log_var.sum(-1)
-        y = y + self._pi_term
-        y = y + torch.log_softmax(self.weight, dim=0)
-        return torch.exp(y)
+        return torch.exp(self._component_log_prob(x.to(self.mean.device)))
 
     def __str__(self):
         return f"""
@@ -452,36 +664,189 @@ class GaussianMixture(nn.Module):
             Number of components: {self.n_mix_comp}
         """
 
-    def sample_new_points(self, resample_type="mean", n_new_samples=1):
+    def sample_new_points(self, resample_type="mean", n_new_samples=1, generator=None):
         """
-        creates a Tensor with potential new representations.
+        creates a Tensor with potential new representations (detached, on the parameter device).
         These can be drawn from component samples if resample_type is 'sample' or
         from the mean if 'mean'. For drawn samples, n_new_samples defines the number
-        of random samples drawn from each component.
+        of random samples drawn from each component, all in one draw.
+        Row i belongs to component i % n_mix_comp.
         """
 
         if resample_type == "mean":
-            samples = self.mean.clone().cpu().detach() # 1 sample, the mean, per gmm component
+            samples = self.mean.detach().clone() # 1 sample, the mean, per gmm component
         else:
-            samples = (
-                self.component_sample(n_new_samples).view(-1, self.dim).cpu().detach()
-            )
+            samples = self.component_sample(n_new_samples, generator=generator).view(-1, self.dim)
         return samples
-    
-    def clustering(self, x):
-        """compute the cluster assignment (as int) for each sample"""
-        return torch.argmax(self.sample_probs(x),dim=-1).to(torch.int16)
+
+    def choose_best_representations(self, x, losses):
+        """
+        reduces several representations per sample to the one with the lowest loss.
+        x has shape (n_sample, n_candidates, dim), or (n_sample * n_candidates, dim) with the candidates
+        of a sample in consecutive rows, losses has shape (n_sample, n_candidates).
+        Returns the best representations (n_sample, dim) and their losses (n_sample)
+        """
+        x = x.reshape(losses.shape[0], losses.shape[1], self.dim)
+        best_loss, best = torch.min(losses, dim=-1)
+        best = best.to(x.device)
+        return x[torch.arange(len(best), device=x.device), best], best_loss
+
+    def choose_old_or_new(self, z_new, loss_new, z_old, loss_old):
+        """
+        keeps per sample (row) the representation with the lower loss, of two tensors of shape (n_sample, dim).
+        Returns the chosen representations and their losses (n_sample)
+        """
+        new = loss_new < loss_old
+        return torch.where(new.unsqueeze(-1).to(z_new.device), z_new, z_old), torch.where(new, loss_new, loss_old)
+
+    def iter_log_probs(self, x, chunk_size=65536):
+        """
+        Streams the per-component log-probs (see sample_log_probs) in chunks of chunk_size samples.
+        Yields (start, log_probs) with log_probs of shape (<=chunk_size, n_mix_comp) on the GMM device.
+        x can be a tensor on any device or a (memory-mapped) numpy array, only one chunk is moved at a time.
+        """
+        with torch.inference_mode():
+            for start, chunk in self._iter_chunks(x, chunk_size):
+                yield start, self._component_log_prob(chunk)
+
+    def _iter_chunks(self, x, chunk_size):
+        """chunks of x moved to the GMM device"""
+        for start in range(0, len(x), chunk_size):
+            yield start, torch.as_tensor(x[start:start + chunk_size], dtype=self.mean.dtype).to(self.mean.device)
+
+    def sample_log_probs(self, x, chunk_size=65536):
+        """log of sample_probs (no underflow), computed in chunks. returns tensor of shape (n_sample, n_mix_comp) on the cpu"""
+        out = torch.empty((len(x), self.n_mix_comp), dtype=self.mean.dtype)
+        for start, y in self.iter_log_probs(x, chunk_size):
+            out[start:start + len(y)] = y.cpu()
+        return out
+
+    def responsibilities(self, x, chunk_size=65536, log=False):
+        """
+        normalized component probabilities per sample (posterior of the component given the sample),
+        computed in log-space and in chunks. returns tensor of shape (n_sample, n_mix_comp) on the cpu
+        """
+        out = torch.empty((len(x), self.n_mix_comp), dtype=self.mean.dtype)
+        for start, y in self.iter_log_probs(x, chunk_size):
+            y = torch.log_softmax(y, dim=-1)
+            out[start:start + len(y)] = (y if log else y.exp()).cpu()
+        return out
+
+    def clustering(self, x, chunk_size=65536):
+        """compute the cluster assignment (as int) for each sample, in chunks of chunk_size samples"""
+        if np.ndim(x) == 1:
+            # single representation, as before
+            return self.clustering(x[None], chunk_size)[0]
+        out = torch.empty(len(x), dtype=torch.int16)
+        for start, y in self.iter_log_probs(x, chunk_size):
+            out[start:start + len(y)] = torch.argmax(y, dim=-1).to(torch.int16).cpu()
+        return out
+
+    def em_update(self, x, n_iter=1, chunk_size=65536, newton_steps=20):
+        """
+        Closed-form MAP (EM) refresh of the means, log-variances and weights from representations x,
+        e.g. every few epochs with x = rep.z. The E-step streams x in chunks and only keeps the
+        per-component sums of the responsibilities, r*x and r*x^2, so memory does not depend on len(x).
+
+        M-step, per component k with N_k = sum of the responsibilities:
+            weights: Dirichlet MAP, (N_k + alpha - 1) / (N + n_mix_comp * (alpha - 1))
+            means: approximate, projected update: the weighted mean of x (the maximum likelihood estimate,
+                ignoring the softball prior), radially projected onto the softball's radius if it lies outside.
+                This is not the exact MAP: the softball log-prob is a logistic function of the norm (not flat
+                inside the radius for sharpness > 0), and it is left to the gradient steps after the refresh.
+                Components without mass keep their mean
+            log-variances: the objective in u = -log_var,
+                0.5*n*u - 0.5*W*exp(u) + log N(u; log_var prior), with W the weighted squared deviations,
+                is concave, and is maximized with newton_steps Newton iterations
+                ('fixed' covariances are not updated)
+        Gradient based training can continue afterwards (the optimizer's moment estimates are kept).
+
+        Args:
+        x: (n_sample, dim) tensor or numpy array
+        n_iter: number of EM iterations
+        chunk_size: number of samples per chunk in the E-step
+        newton_steps: Newton iterations for the log-variances
+
+        Returns:
+        mean log density of x (without priors) before the last update
+        """
+        with torch.no_grad():
+            for _ in range(n_iter):
+                # E-step: sufficient statistics
+                n_k = torch.zeros(self.n_mix_comp, device=self.mean.device)
+                sum_x = torch.zeros(self.n_mix_comp, self.dim, device=self.mean.device)
+                sum_x2 = torch.zeros(self.n_mix_comp, self.dim, device=self.mean.device)
+                log_density = 0.
+                with torch.inference_mode():
+                    for start, chunk in self._iter_chunks(x, chunk_size):
+                        y = self._component_log_prob(chunk)
+                        log_density += torch.logsumexp(y, dim=-1).sum().item()
+                        r = torch.softmax(y, dim=-1)
+                        n_k += r.sum(0)
+                        sum_x += r.T @ chunk
+                        sum_x2 += r.T @ chunk.square()
+                self._m_step(n_k, sum_x, sum_x2, newton_steps)
+        return log_density / len(x)
+
+    def _m_step(self, n_k, sum_x, sum_x2, newton_steps):
+        """closed form MAP updates from the E-step sums, see em_update"""
+        # weights (softmax is shift-invariant, so the log-probabilities can be used directly)
+        alpha = self._weight_alpha
+        probs = (n_k + alpha - 1).clamp(min=1e-6)
+        self._weight.copy_(torch.log(probs / probs.sum()))
+
+        # means: weighted mean, projected onto the softball radius (approximate, see em_update)
+        has_mass = n_k > 1e-6
+        mean = torch.where(has_mass.unsqueeze(1), sum_x / n_k.clamp(min=1e-6).unsqueeze(1), self.mean)
+        norm = mean.norm(dim=-1, keepdim=True)
+        radius = self._mean_prior.radius
+        mean = torch.where(norm > radius, mean * radius / norm, mean)
+        self._mean.copy_(mean)
+
+        if not self._log_var.requires_grad:
+            return
+        # squared deviations from the new means
+        w = (sum_x2 - 2 * mean * sum_x + n_k.unsqueeze(1) * mean.square()).clamp(min=0)
+        n = n_k.unsqueeze(1).expand_as(w)
+        if self._log_var_dim == 1:
+            # isotropic: one variance for all dimensions
+            w = w.sum(-1, keepdim=True)
+            n = n[:, :1] * self.dim
+        prior_mean, prior_var = self._log_var_prior.mean, self._log_var_prior.stddev ** 2
+        # the root of the gradient is <= max(prior mean, ML estimate), and Newton on this concave objective
+        # converges monotonically from above, so start there
+        u = torch.maximum(torch.log((n + 1e-12) / (w + 1e-12)), torch.full_like(w, prior_mean))
+        for _ in range(newton_steps):
+            grad = 0.5 * n - 0.5 * w * torch.exp(u) - (u - prior_mean) / prior_var
+            hess = -0.5 * w * torch.exp(u) - 1.0 / prior_var
+            u = u - grad / hess
+        self._log_var.copy_(-u)
 
 class GaussianMixtureSupervised(GaussianMixture):
     """
     Supervised GaussianMixutre class.
 
+    The components are grouped in Nclass blocks of Ncpc components (component c*Ncpc + j is the j-th
+    component of class c). A labelled sample is scored only against the components of its class,
+    as a mixture with the weights normalized within the class. Unlabelled samples use the full mixture.
+
     Attributes
     ----------
     Nclass: int
         number of classes to be modeled
     Ncpc: int
         number of components that should model each class
+
+    Methods
+    ----------
+    forward(x, label=None)
+        negative log density of x under the mixture of its class (or the full mixture if label is None)
+    class_log_prob(x, label)
+        log density of x under the mixture of its class (without priors)
+    label_mixture_probs(label)
+        mixture probabilities of the components within the given classes
+    supervised_sampling(label, sample_type='random')
+        one new point per label from the components of that class
     """
 
     def __init__(
@@ -499,31 +864,62 @@ class GaussianMixtureSupervised(GaussianMixture):
         self.Nclass = Nclass # number of classes in the data
         self.Ncpc = Ncompperclass # number of components per class
 
+    def _label_tensor(self, label):
+        """class indices as a long tensor on the GMM device (e.g. from pd.factorize(dataset.labels))"""
+        return torch.as_tensor(label, device=self.mean.device).long()
+
+    def class_log_prob(self, x, label):
+        """
+        log density of every sample under the mixture of the Ncpc components of its class, shape (n_sample).
+        The (Nclass, Ncpc) parameter blocks of the labels are gathered, so the cost is n_sample*Ncpc*dim
+        instead of n_sample*n_mix_comp*dim.
+        """
+        x = x.to(self.mean.device)
+        label = self._label_tensor(label)
+        mean = self.mean.view(self.Nclass, self.Ncpc, -1)[label] # (n_sample, Ncpc, dim)
+        precision = torch.exp(-self.log_var).view(self.Nclass, self.Ncpc, -1)[label] # (n_sample, Ncpc, 1 or dim)
+
+        y = -0.5 * (x.unsqueeze(-2) - mean).square().mul(precision).sum(-1)
+        # per component constants, with the mixture weights normalized within each class
+        const = (
+            - self._log_var_factor * self.log_var.sum(-1).view(self.Nclass, self.Ncpc)
+            + self._pi_term
+            + torch.log_softmax(self.weight.view(self.Nclass, self.Ncpc), dim=-1)
+        )
+        y = y + const[label]
+        return torch.logsumexp(y, dim=-1)
+
     def forward(self,x,label=None):
 
         # return unsupervized loss if there are no labels provided
         if label is None:
             y = super().forward(x)
             return y
-        
-        y = y + self._log_var_factor * self.log_var.view(self.Nclass,self.Ncpc,-1).sum(-1)
-        y = y + self._pi_term
-        y += torch.log_softmax(self.weight.view(self.Nclass,self.Ncpc),dim=-1)
-        y = y.sum(-1)
-        y = y[(np.arange(y.shape[0]),label)] * self.Nclass # this is replacement for logsumexp of supervised samples
-        
-        y = y + self._prior_log_prob()
+
+        y = self.class_log_prob(x, label)
+        y = y + self._prior_term()
         return - y
 
     def label_mixture_probs(self,label):
-        return torch.softmax(self.weight[label],dim=-1)
+        """mixture probabilities within the classes of the labels, shape (n_label, Ncpc)"""
+        return torch.softmax(self.weight.view(self.Nclass, self.Ncpc)[self._label_tensor(label)], dim=-1)
     
     def supervised_sampling(self, label, sample_type='random'):
-        # get samples for each component
-        if sample_type == 'origin':
-            # choose the component means
-            samples = self.mean.clone().detach().unsqueeze(0).repeat(len(label),1,1)
-        else:
-            samples = self.component_sample(len(label))
-        # then select the correct component
-        return samples[range(len(label)),label]
\ No newline at end of file
+        """
+        One new point per label, from the components of that class (on the GMM device).
+        'random' draws a component with the class mixture probabilities and samples from it,
+        'origin' returns the mean of the most probable component of the class.
+        """
+        with torch.no_grad():
+            label = self._label_tensor(label)
+            probs = self.label_mixture_probs(label)
+            if sample_type == 'origin':
+                comp = probs.argmax(dim=-1)
+            else:
+                comp = torch.multinomial(probs, 1).squeeze(-1)
+            comp = label * self.Ncpc + comp
+            samples = self.mean[comp].clone()
+            if sample_type != 'origin':
+                _, stddev = self._sampling_params()
+                samples += torch.randn_like(samples) * stddev[comp]
+            return samples
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import math
+from typing import Optional
 
 def logNBdensity(k, m, r):
     """
@@ -21,6 +22,99 @@ def logNBdensity(k, m, r):
     x += r * torch.log(r * (r + m + eps) ** (-1))
     return x
 
+def _nb_terms(m, r, eps: float):
+    """
+    shared terms of the fused NB density: log(r+m+eps) and log(m + eps*(r+m+eps)).
+    k*log(m/(r+m+eps) + eps) = k*(log(m + eps*(r+m+eps)) - log(r+m+eps)), so both logs of logNBdensity
+    share one log(r+m+eps) and no reciprocals are needed
+    """
+    s = r + m + eps
+    log_s = torch.log(s)
+    log_a = torch.log(s.mul_(eps).add_(m))
+    return log_s, log_a
+
+
+def _nb_forward(k, m, r, eps: float, log_k_fact: Optional[torch.Tensor] = None,
+                lgamma_r: Optional[torch.Tensor] = None, exact: bool = True):
+    log_s, log_a = _nb_terms(m, r, eps)
+    x = k * log_a.sub_(log_s) # has the full broadcast shape, the other terms are added in place
+    x += torch.lgamma(k + r)
+    if lgamma_r is None:
+        x -= torch.lgamma(r)
+    else:
+        x -= lgamma_r
+    if exact:
+        if log_k_fact is None:
+            x -= torch.lgamma(k + 1)
+        else:
+            x -= log_k_fact
+    x += r * log_s.neg_().add_(torch.log(r))
+    return x
+
+
+class _LogNBDensity(torch.autograd.Function):
+    """
+    logNBdensity with a hand-written backward. Computed in float32 (also for bfloat16/float16 inputs,
+    where lgamma/digamma lose too much precision) and returned in the input dtype.
+    Only the inputs are saved for backward; the shared terms are recomputed there.
+    """
+
+    @staticmethod
+    def forward(ctx, k, m, r, eps, log_k_fact, lgamma_r, exact):
+        dtype = torch.promote_types(torch.promote_types(k.dtype, m.dtype), r.dtype)
+        k32, m32, r32 = (t.float() for t in (k, m, r))
+        ctx.save_for_backward(k32, m32, r32)
+        ctx.eps = eps
+        ctx.exact = exact
+        ctx.shapes = (k.shape, m.shape, r.shape)
+        ctx.dtypes = (k.dtype, m.dtype, r.dtype)
+        return _nb_forward(k32, m32, r32, eps, log_k_fact, lgamma_r, exact).to(dtype)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        k, m, r = ctx.saved_tensors
+        eps = ctx.eps
+        grad_output = grad_output.float()
+        s = r + m + eps
+        a = s * eps + m
+        kr_s = (k + r) / s
+        grad_k = grad_m = grad_r = None
+        if ctx.needs_input_grad[0]:
+            grad_k = torch.digamma(k + r) + torch.log(a) - torch.log(s)
+            if ctx.exact:
+                grad_k -= torch.digamma(k + 1)
+            grad_k = (grad_output * grad_k).sum_to_size(ctx.shapes[0]).to(ctx.dtypes[0])
+        if ctx.needs_input_grad[1]:
+            grad_m = k * (1 + eps) / a - kr_s
+            grad_m = (grad_output * grad_m).sum_to_size(ctx.shapes[1]).to(ctx.dtypes[1])
+        if ctx.needs_input_grad[2]:
+            grad_r = torch.digamma(k + r) - torch.digamma(r) + k * eps / a + torch.log(r / s) + 1 - kr_s
+            grad_r = (grad_output * grad_r).sum_to_size(ctx.shapes[2]).to(ctx.dtypes[2])
+        return grad_k, grad_m, grad_r, None, None, None, None
+
+
+def fused_logNBdensity(k, m, r, eps=1.0e-10, log_k_fact=None, lgamma_r=None, exact=True):
+    """
+    Same value as logNBdensity (up to rounding), with fewer temporaries:
+    log(r+m) is shared between the two log terms, reciprocals are replaced by log differences,
+    and the intermediate results are updated in place. With gradients a custom autograd Function
+    is used, which saves only the inputs; without gradients the plain (TorchScript-friendly) forward runs.
+
+    The terms that do not depend on m can be passed in precomputed:
+    log_k_fact: lgamma(k + 1), e.g. from FlattenedDataset.log_factorial (the counts never change)
+    lgamma_r: lgamma(r) (detached, the gradient w.r.t. r is still computed), e.g. cached by NB_Module
+    exact: if False the lgamma(k + 1) term is dropped. It is constant, so the gradients are the same
+        (optimization-only loss); the exact value is the result minus lgamma(k + 1)
+    """
+    if torch.is_grad_enabled() and (k.requires_grad or m.requires_grad or r.requires_grad):
+        return _LogNBDensity.apply(k, m, r, eps, log_k_fact, lgamma_r, exact)
+    dtype = torch.promote_types(torch.promote_types(k.dtype, m.dtype), r.dtype)
+    if dtype in (torch.float16, torch.bfloat16):
+        k, m, r = k.float(), m.float(), r.float()
+        return _nb_forward(k, m, r, eps, log_k_fact, lgamma_r, exact).to(dtype)
+    return _nb_forward(k, m, r, eps, log_k_fact, lgamma_r, exact)
+
 class OutputModule(nn.Module):
     """
     This is the basis output module class that stands between the decoder and the output data.
@@ -71,6 +165,8 @@ class NB_Module(OutputModule):
     Attributes
     ----------
     fc: torch.nn.modules.container.ModuleList
+    n_features: int
+        number of features modelled by this module (out_features)
     log_r: torch.nn.parameter.Parameter
         log-dispersion parameter per feature
 
@@ -93,6 +189,7 @@ class NB_Module(OutputModule):
             and determines what activation function is used on the output
         """
         super(NB_Module, self).__init__(fc, out_features)
+        self.n_features = out_features # used by the Decoder (n_out_features, log_prob with reduction 'none')
 
         # substracting 1 now and adding it to the learned dispersion ensures a minimum value of 1
         self.log_r = torch.nn.Parameter(
@@ -130,21 +227,39 @@ class NB_Module(OutputModule):
         #print("model_output:", model_output.shape)
         return scaling_factor * model_output
 
-    def log_prob(self, model_output, target, scaling_factor, feature_id=None):
+    def _lgamma_r(self):
+        """lgamma of the dispersion (detached), cached until log_r is updated (its _version changes)"""
+        key = (self.log_r._version, self.log_r.device)
+        cache = self.__dict__.get("_lgamma_r_cache")
+        if cache is None or cache[0] != key:
+            with torch.no_grad():
+                self._lgamma_r_cache = (key, torch.lgamma(torch.exp(self.log_r.float()) + 1))
+            cache = self._lgamma_r_cache
+        return cache[1]
+
+    def log_prob(self, model_output, target, scaling_factor, feature_id=None, log_k_fact=None, exact=True):
         # the model output represents the mean normalized count
         # the scaling factor is the used normalization
+        # log_k_fact: precomputed lgamma(target + 1) (see FlattenedDataset.log_factorial),
+        # exact=False drops that constant term (optimization-only loss, same gradients)
         if feature_id is not None:  # feature_id could be a single gene
-            return logNBdensity(
+            return fused_logNBdensity(
                 target,
                 self.rescale(scaling_factor, model_output),
                 (torch.exp(self.log_r) + 1)[0, feature_id],
+                log_k_fact=log_k_fact,
+                lgamma_r=self._lgamma_r()[0, feature_id],
+                exact=exact,
             )
         else:
-            return logNBdensity(
+            return fused_logNBdensity(
                 
                 target,
                 self.rescale(scaling_factor, model_output),
                 (torch.exp(self.log_r) + 1),
+                log_k_fact=log_k_fact,
+                lgamma_r=self._lgamma_r(),
+                exact=exact,
             )
 
     def loss(self, model_output, target, scaling_factor, gene_id=None):
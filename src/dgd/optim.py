@@ -0,0 +1,83 @@
+import torch
+
+class RowAdamW(torch.optim.Optimizer):
+    """
+    AdamW with row-wise lazy updates, for representation tables (e.g. SparseRepresentationLayer.z).
+
+    Only the rows present in the gradient are updated: the moment estimates of the other rows are
+    left untouched (not decayed), and every row keeps its own step count for the bias correction.
+    The decoupled weight decay is likewise only applied to the rows of the batch.
+    The cost of a step therefore depends on the batch, not on the number of rows in the table.
+
+    Sparse gradients (from SparseRepresentationLayer) are used as they are. For dense gradients the
+    rows with a non-zero gradient are taken as the rows of the batch.
+    For a table whose rows are all seen every step, this is the same as torch.optim.AdamW.
+
+    Attributes
+    ----------
+    state[p]: dict
+        exp_avg, exp_avg_sq: moment estimates of shape p.shape
+        step: number of updates per row, shape (p.shape[0])
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2):
+        """Args:
+        params: iterable of parameters (or parameter groups), each a table with one row per sample
+        lr: learning rate
+        betas: coefficients of the running averages of the gradient and its square
+        eps: term added to the denominator
+        weight_decay: decoupled weight decay (as in AdamW)
+        """
+        if lr < 0.0:
+            raise ValueError(f"Invalid learning rate: {lr}")
+        if not 0.0 <= betas[0] < 1.0 or not 0.0 <= betas[1] < 1.0:
+            raise ValueError(f"Invalid beta parameters: {betas}")
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(RowAdamW, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                if grad.is_sparse:
+                    grad = grad.coalesce() # sums the gradients of repeated indices
+                    rows, values = grad.indices()[0], grad.values()
+                else:
+                    rows = torch.nonzero(grad.reshape(len(grad), -1).any(dim=1)).squeeze(1)
+                    values = grad[rows]
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state["exp_avg"] = torch.zeros_like(p)
+                    state["exp_avg_sq"] = torch.zeros_like(p)
+                    state["step"] = torch.zeros(len(p), dtype=p.dtype, device=p.device)
+
+                step = state["step"][rows] + 1
+                state["step"][rows] = step
+                exp_avg = state["exp_avg"][rows].mul_(beta1).add_(values, alpha=1 - beta1)
+                exp_avg_sq = state["exp_avg_sq"][rows].mul_(beta2).addcmul_(values, values, value=1 - beta2)
+                state["exp_avg"][rows] = exp_avg
+                state["exp_avg_sq"][rows] = exp_avg_sq
+
+                # per row bias correction
+                shape = (-1,) + (1,) * (p.dim() - 1)
+                bias_correction1 = (1 - beta1 ** step).view(shape)
+                bias_correction2 = (1 - beta2 ** step).view(shape)
+                denom = (exp_avg_sq / bias_correction2).sqrt_().add_(group["eps"])
+
+                p_rows = p[rows]
+                if group["weight_decay"] != 0:
+                    p_rows.mul_(1 - group["lr"] * group["weight_decay"])
+                p_rows.addcdiv_(exp_avg / bias_correction1, denom, value=-group["lr"])
+                p[rows] = p_rows
+
+        return loss
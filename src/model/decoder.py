@@ -1,14 +1,89 @@
+import contextlib
+import os
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from src.utils.helpers import get_activation
 
+class FactorizedLinear(nn.Linear):
+    '''
+    nn.Linear over an input that is the concatenation of several blocks, e.g. torch.cat((z, mut_z, onehot), dim=1).
+
+    The weight is split column-wise into one block per input, W @ cat(x_1, ..., x_n) = W_1 @ x_1 + ... + W_n @ x_n,
+    so each block can be projected separately. forward_parts() takes the blocks as lookup tables plus row indices
+    (e.g. the sample representations and sample_idx) and projects every distinct table row once per batch instead
+    of once per flattened row, then gathers and adds the partial products.
+    Parameters and state_dict are those of the nn.Linear it replaces, and forward() on the concatenated input is unchanged.
+
+    Parameters
+    ----------
+    split_sizes: list of int
+        sizes of the concatenated input blocks (sum is in_features)
+    out_features: int
+        number of output features
+    '''
+    def __init__(self, split_sizes, out_features, bias=True):
+        super(FactorizedLinear, self).__init__(sum(split_sizes), out_features, bias=bias)
+        self.split_sizes = list(split_sizes)
+
+    def partial(self, i, x):
+        """product of input block i with its weight columns (no bias)"""
+        start = sum(self.split_sizes[:i])
+        return F.linear(x, self.weight[:, start:start + self.split_sizes[i]])
+
+    def forward_parts(self, parts):
+        '''
+        Same output as forward(torch.cat(rows, dim=1)), computed from the factorized inputs.
+
+        Args:
+        parts: list with one entry per input block, either
+            a (B, split_size) tensor with one row per output row, or
+            a tuple (table, index) of a (n, split_size) tensor and B row indices into it
+        '''
+        out = None
+        for i, part in enumerate(parts):
+            if isinstance(part, tuple):
+                table, index = part
+                if len(table) <= len(index):
+                    # fewer table rows than batch rows: project the whole table
+                    y = self.partial(i, table)[index]
+                else:
+                    # only project the rows that occur in the batch
+                    rows, inverse = torch.unique(index, return_inverse=True)
+                    y = self.partial(i, table[rows])[inverse]
+            else:
+                y = self.partial(i, part)
+            out = y if out is None else out + y
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+    def extra_repr(self):
+        return super(FactorizedLinear, self).extra_repr() + f', split_sizes={self.split_sizes}'
+
+
 class Decoder(nn.Module):
-    def __init__(self, input_dim: int, hidden_dims: list, output_modules: list, activation="relu"):
+    autocast_dtype = None # class default, so decoders pickled before set_autocast existed still load and run in float32
+
+    def __init__(self, input_dim: int, hidden_dims: list, output_modules: list, activation="relu", input_split=None,
+                 autocast_dtype=None):
+        '''
+        input_split: optional list of the sizes of the concatenated input blocks (e.g. [rep_dim, mut_rep_dim, onehot_dim]).
+            The first layer is then a FactorizedLinear, and forward_parts() can be used instead of forward(torch.cat(...)).
+        autocast_dtype: optional mixed precision, see set_autocast
+        '''
         super(Decoder, self).__init__()
+        self.autocast_dtype = autocast_dtype
+        if input_split is not None and sum(input_split) != input_dim:
+            raise ValueError("input_split must sum to input_dim")
         # set up the shared decoder
         self.main = nn.ModuleList()
         for i in range(len(hidden_dims)):
-            self.main.append(nn.Linear(input_dim, hidden_dims[i]))
+            if i == 0 and input_split is not None:
+                self.main.append(FactorizedLinear(input_split, hidden_dims[i]))
+            else:
+                self.main.append(nn.Linear(input_dim, hidden_dims[i]))
             self.main.append(get_activation(activation))
             input_dim = hidden_dims[i]
         
@@ -19,13 +94,141 @@ class Decoder(nn.Module):
         self.n_out_groups = len(output_modules)
         self.n_out_features = sum([output_modules[i].n_features for i in range(self.n_out_groups)])
         
+    def set_autocast(self, dtype=torch.bfloat16):
+        '''
+        Opt-in mixed precision: the hidden layers of main run under torch.autocast with this dtype
+        (e.g. torch.bfloat16 on the cpu, which uses AVX512-BF16/AMX where available), while the parameters
+        stay float32. The output modules run outside autocast on the float32 hidden activations, so the NB
+        means, the log-likelihoods and everything outside the decoder (GMM, representations) stay in float32.
+        None switches back to float32.
+        '''
+        self.autocast_dtype = dtype
+        return self
+
+    def _autocast(self, device):
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=device.type, dtype=self.autocast_dtype)
+
+    def _output(self, z):
+        # called outside the autocast context: the output activations (NB means) are computed in float32
+        return [outmod(z.float()) for outmod in self.out_modules]
+
     def forward(self, z):
-        for i in range(len(self.main)):
-            z = self.main[i](z)
-        out = [outmod(z) for outmod in self.out_modules]
+        with self._autocast(z.device):
+            for i in range(len(self.main)):
+                z = self.main[i](z)
+        out = self._output(z)
+        return out
+
+    def forward_parts(self, parts):
+        '''
+        forward() with a factorized input (requires input_split), see FactorizedLinear.forward_parts.
+        E.g. in the per-mutation DGD, instead of forward(torch.cat((rep.z[sample_idx], mut_rep.z[mut_idx], onehot), dim=1)):
+            forward_parts([(rep.z, sample_idx), (mut_rep.z, mut_idx), (context.table, mut_idx)])
+        '''
+        if not isinstance(self.main[0], FactorizedLinear):
+            raise ValueError("forward_parts requires a decoder built with input_split")
+        with self._autocast(self.main[0].weight.device):
+            z = self.main[0].forward_parts(parts)
+            for i in range(1, len(self.main)):
+                z = self.main[i](z)
+        out = self._output(z)
         return out
     
-    def log_prob(self, nn_output, target, scale=1, mod_id=None, feature_ids=None, reduction="sum"):
+    def grid_tile_shape(self, n_samples, n_muts, memory_budget=2**28, mod_id=0):
+        '''
+        (samples, mutations) per tile of decode_grid, so that the activations of one tile
+        (pre-activation + activation of every layer, plus mean, target, scale and log-prob per cell)
+        stay within memory_budget bytes
+        '''
+        widths = [layer.out_features for layer in self.main if isinstance(layer, nn.Linear)]
+        widths += [layer.out_features for layer in self.out_modules[mod_id].modules() if isinstance(layer, nn.Linear)]
+        bytes_per_cell = 4 * (2 * sum(widths) + 4)
+        cells = max(1, memory_budget // bytes_per_cell)
+        tile_muts = min(n_muts, cells)
+        tile_samples = min(n_samples, max(1, cells // tile_muts))
+        return tile_samples, tile_muts
+
+    @torch.no_grad()
+    def decode_grid(self, sample_inputs, mut_inputs, target=None, scale=None, mod_id=0, memory_budget=2**28, out_dir=None):
+        '''
+        Decoder output for every (sample, mutation) pair, i.e. forward(torch.cat((sample_inputs[i], mut_inputs[j])))
+        for the full N x M grid, without building the N*M flattened input rows.
+
+        The first layer is split into its sample and mutation columns, so both blocks are projected once;
+        each tile of the grid is the broadcast sum of the two projections, passed through the remaining layers.
+        The output module mod_id must have one output per row (the per-mutation DGD).
+
+        Args:
+        sample_inputs: (N, d_s) tensor, e.g. the sample representations
+        mut_inputs: (M, d_m) tensor, e.g. torch.cat((mut_rep.z, context_matrix), dim=1)
+        target: optional (N, M) counts (tensor or numpy array, e.g. dataset.mut_matrix) for the NB log-likelihoods
+        scale: optional (N, 1) scaling factors (e.g. dataset.lib_values); the returned means are scale * output
+        mod_id: output module to evaluate
+        memory_budget: approximate bytes of activations per tile (see grid_tile_shape)
+        out_dir: if given, the matrices are written to out_dir/mean.npy and out_dir/log_prob.npy
+            (memory-mapped) instead of being kept in memory
+
+        Returns:
+        dict with the (N, M) 'mean' matrix and, if target is given, the (N, M) 'log_prob' matrix
+        '''
+        outmod = self.out_modules[mod_id]
+        if getattr(outmod, 'n_features', 1) != 1:
+            raise ValueError("decode_grid requires an output module with one output per row")
+        dev = self.main[0].weight.device
+        sample_inputs = torch.as_tensor(sample_inputs, dtype=torch.float32).to(dev)
+        mut_inputs = torch.as_tensor(mut_inputs, dtype=torch.float32).to(dev)
+        n_samples, n_muts = len(sample_inputs), len(mut_inputs)
+
+        # W @ cat(x_s, x_m) + b = (W_s @ x_s + b) + W_m @ x_m
+        first = self.main[0]
+        d_s = sample_inputs.shape[1]
+        sample_part = F.linear(sample_inputs, first.weight[:, :d_s], first.bias)
+        mut_part = F.linear(mut_inputs, first.weight[:, d_s:])
+
+        names = ['mean'] + (['log_prob'] if target is not None else [])
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+            result = {name: np.lib.format.open_memmap(os.path.join(out_dir, f'{name}.npy'), mode='w+', dtype=np.float32,
+                                                      shape=(n_samples, n_muts)) for name in names}
+        else:
+            result = {name: torch.empty((n_samples, n_muts)) for name in names}
+
+        tile_samples, tile_muts = self.grid_tile_shape(n_samples, n_muts, memory_budget, mod_id)
+        for s0 in range(0, n_samples, tile_samples):
+            s1 = min(s0 + tile_samples, n_samples)
+            for m0 in range(0, n_muts, tile_muts):
+                m1 = min(m0 + tile_muts, n_muts)
+                z = (sample_part[s0:s1, None, :] + mut_part[None, m0:m1, :]).flatten(0, 1)
+                with self._autocast(dev):
+                    for i in range(1, len(self.main)):
+                        z = self.main[i](z)
+                y = outmod(z.float()).view(s1 - s0, m1 - m0)
+
+                if scale is None:
+                    tile_scale = torch.ones((s1 - s0, 1), device=dev)
+                else:
+                    tile_scale = torch.as_tensor(scale[s0:s1], dtype=torch.float32).to(dev).view(-1, 1)
+                tile = {'mean': tile_scale * y} # the NB mean, see NB_Module.rescale
+                if target is not None:
+                    tile_target = torch.as_tensor(target[s0:s1, m0:m1], dtype=torch.float32).to(dev)
+                    tile['log_prob'] = outmod.log_prob(
+                        y.reshape(-1, 1), tile_target.reshape(-1, 1), tile_scale.expand_as(y).reshape(-1, 1)
+                    ).view(s1 - s0, m1 - m0)
+                for name in names:
+                    if out_dir is not None:
+                        result[name][s0:s1, m0:m1] = tile[name].cpu().numpy()
+                    else:
+                        result[name][s0:s1, m0:m1] = tile[name].cpu()
+
+        if out_dir is not None:
+            for name in names:
+                result[name].flush()
+        return result
+
+    def log_prob(self, nn_output, target, scale=1, mod_id=None, feature_ids=None, reduction="sum", weight=None,
+                 log_k_fact=None, exact=True):
         '''
         calculating the log probability
         
@@ -46,33 +249,57 @@ class Decoder(nn.Module):
             the ids of the features to calculate the log-prob for (if a subset is desired, only works if mod_id is not None)
         reduction: str
             the reduction method to use ('sum', 'mean', 'none')
+        weight: list of tensors
+            per-element weights multiplied onto the log-probs before reduction, e.g. the zero-sampling
+            weights of SparseFlattenedDataset (None for unweighted, a single tensor if mod_id is given)
+        log_k_fact: list of tensors
+            precomputed lgamma(target + 1) of NB output modules, e.g. from FlattenedDataset.log_factorial
+            (None to compute it, a single tensor if mod_id is given)
+        exact: bool
+            if False, NB output modules drop the constant lgamma(target + 1) term (optimization-only loss,
+            same gradients); keep True for reported likelihoods
         '''
+        def weighted(log_prob, i):
+            if weight is None:
+                return log_prob
+            return log_prob * (weight if mod_id is not None else weight[i])
+
+        def target_terms(i):
+            # only passed on if used, so other output modules keep their log_prob signature
+            kwargs = {}
+            if log_k_fact is not None:
+                kwargs['log_k_fact'] = log_k_fact if mod_id is not None else log_k_fact[i]
+            if not exact:
+                kwargs['exact'] = exact
+            return kwargs
+
         if reduction == 'sum':
             log_prob = 0.
             if mod_id is not None:
-                log_prob += self.out_modules[mod_id].log_prob(nn_output,target,scale,feature_id=feature_ids).sum()
+                log_prob += weighted(self.out_modules[mod_id].log_prob(nn_output,target,scale,feature_id=feature_ids,**target_terms(mod_id)), mod_id).sum()
             else:
                 for i in range(self.n_out_groups):
-                    log_prob += self.out_modules[i].log_prob(nn_output[i],target[i],scale[i]).sum()
+                    log_prob += weighted(self.out_modules[i].log_prob(nn_output[i],target[i],scale[i],**target_terms(i)), i).sum()
         elif reduction == 'mean':
             log_prob = 0.
             if mod_id is not None:
-                log_prob += self.out_modules[mod_id].log_prob(nn_output,target,scale,feature_id=feature_ids).mean()
+                log_prob += weighted(self.out_modules[mod_id].log_prob(nn_output,target,scale,feature_id=feature_ids,**target_terms(mod_id)), mod_id).mean()
             else:
                 for i in range(self.n_out_groups):
-                    log_prob += self.out_modules[i].log_prob(nn_output[i],target[i],scale[i]).mean()
+                    log_prob += weighted(self.out_modules[i].log_prob(nn_output[i],target[i],scale[i],**target_terms(i)), i).mean()
         else:
             dev = torch.device("cuda" if torch.cuda.is_available() else "cpu")
             if mod_id is not None:
-                log_prob = self.out_modules[mod_id].log_prob(nn_output,target,scale)
+                log_prob = weighted(self.out_modules[mod_id].log_prob(nn_output,target,scale,**target_terms(mod_id)), mod_id)
             else:
                 n_features = sum([self.out_modules[i].n_features for i in range(self.n_out_groups)])
                 log_prob = torch.zeros((nn_output[0].shape[0],n_features)).to(dev)
                 start_features = 0
                 for i in range(self.n_out_groups):
-                    log_prob[:,start_features:(start_features+self.out_modules[i].n_features)] += self.out_modules[i].log_prob(nn_output[i],target[i],scale[i])
+                    log_prob[:,start_features:(start_features+self.out_modules[i].n_features)] += weighted(self.out_modules[i].log_prob(nn_output[i],target[i],scale[i],**target_terms(i)), i)
                     start_features += self.out_modules[i].n_features
         return log_prob
     
-    def loss(self, nn_output, target, scale=None, mod_id=None, feature_ids=None, reduction="sum"):
-        return -self.log_prob(nn_output, target, scale, mod_id, feature_ids, reduction)
\ No newline at end of file
+    def loss(self, nn_output, target, scale=None, mod_id=None, feature_ids=None, reduction="sum", weight=None,
+             log_k_fact=None, exact=True):
+        return -self.log_prob(nn_output, target, scale, mod_id, feature_ids, reduction, weight, log_k_fact, exact)
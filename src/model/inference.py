@@ -0,0 +1,139 @@
+import copy
+from typing import List
+import torch
+import torch.nn as nn
+
+from src.dgd.nn import NB_Module, _nb_forward
+
+# Inference export of a trained Decoder with its NB output heads.
+# The decoder is copied into plain modules (nn.Sequential of the layers, one _NBHead per output module,
+# dispersions as buffers) and compiled with TorchScript into a single frozen graph, without the Python
+# loops over main/out_modules and without any parameters that require grad.
+# The saved file can be loaded with torch.jit.load (or load_decoder) without this repo's classes or the
+# notebooks' DGD class. Run it through decode()/log_prob(), which use torch.inference_mode.
+#
+#   engine = export_decoder(dgd.decoder, "decoder.pt")
+#   engine = load_decoder("decoder.pt")
+#   means = decode(engine, torch.cat((z, mut_z, onehot), dim=1))[0]
+
+
+class _NBHead(nn.Module):
+    """frozen copy of an NB_Module: its network, its output activation and the dispersion as a buffer"""
+
+    def __init__(self, head: NB_Module):
+        super(_NBHead, self).__init__()
+        self.fc = nn.Sequential(*[copy.deepcopy(layer) for layer in head.fc])
+        self.activation = head._activation
+        self.register_buffer("dispersion", head.dispersion.detach().clone())
+        self.eps = 1.0e-10
+
+    def forward(self, x):
+        x = self.fc(x)
+        if self.activation == "softmax":
+            return torch.softmax(x, dim=-1)
+        elif self.activation == "softplus":
+            return torch.nn.functional.softplus(x)
+        elif self.activation == "sigmoid":
+            return torch.sigmoid(x)
+        return x
+
+    @torch.jit.export
+    def log_prob(self, model_output, target, scaling_factor):
+        return _nb_forward(target, scaling_factor * model_output, self.dispersion, self.eps)
+
+
+class DecoderInference(nn.Module):
+    """
+    Autograd-free copy of a Decoder and its NB output modules, in a TorchScript-compatible form.
+
+    Methods
+    ----------
+    forward(z)
+        list with the output of every head (like Decoder.forward)
+    log_prob(z, target, scale)
+        list with the NB log-likelihoods of every head (like Decoder.log_prob with reduction 'none')
+    """
+
+    def __init__(self, decoder):
+        super(DecoderInference, self).__init__()
+        layers = []
+        for layer in decoder.main:
+            if isinstance(layer, nn.Linear):
+                # plain nn.Linear, also for a FactorizedLinear first layer
+                linear = nn.Linear(layer.in_features, layer.out_features, bias=layer.bias is not None)
+                linear.load_state_dict(layer.state_dict())
+                layers.append(linear)
+            else:
+                layers.append(copy.deepcopy(layer))
+        self.main = nn.Sequential(*layers)
+        for outmod in decoder.out_modules:
+            if not isinstance(outmod, NB_Module):
+                raise ValueError("only NB_Module output modules can be exported")
+        self.heads = nn.ModuleList([_NBHead(outmod) for outmod in decoder.out_modules])
+        self.requires_grad_(False)
+        self.eval()
+
+    def forward(self, z) -> List[torch.Tensor]:
+        z = self.main(z)
+        out: List[torch.Tensor] = []
+        for head in self.heads:
+            out.append(head(z))
+        return out
+
+    @torch.jit.export
+    def log_prob(self, z, target: List[torch.Tensor], scale: List[torch.Tensor]) -> List[torch.Tensor]:
+        z = self.main(z)
+        out: List[torch.Tensor] = []
+        for i, head in enumerate(self.heads):
+            out.append(head.log_prob(head(z), target[i], scale[i]))
+        return out
+
+
+def export_decoder(decoder, path=None):
+    """
+    Freeze a trained decoder (with NB output modules) into a TorchScript graph.
+
+    Args:
+        decoder: Decoder, e.g. dgd.decoder
+        path: if given, the graph is saved there with torch.jit.save
+
+    Returns:
+        the frozen ScriptModule
+    """
+    module = DecoderInference(decoder).to(next(decoder.parameters()).device)
+    scripted = torch.jit.freeze(torch.jit.script(module), preserved_attrs=["log_prob"])
+    if path is not None:
+        torch.jit.save(scripted, path)
+    return scripted
+
+
+def load_decoder(path, map_location=None):
+    """load an exported decoder; only needs torch"""
+    return torch.jit.load(path, map_location=map_location)
+
+
+def compile_decoder(decoder, **compile_kwargs):
+    """
+    torch.compile version of DecoderInference, for use within the same process (it cannot be saved;
+    use export_decoder for a file). Run it through decode()/log_prob() as well.
+    """
+    return torch.compile(DecoderInference(decoder).to(next(decoder.parameters()).device), **compile_kwargs)
+
+
+def decode(engine, z, batch_size=65536):
+    """outputs of all heads for the decoder inputs z, in batches under torch.inference_mode"""
+    with torch.inference_mode():
+        chunks = [engine(z[start:start + batch_size]) for start in range(0, len(z), batch_size)]
+    return [torch.cat([chunk[i] for chunk in chunks]) for i in range(len(chunks[0]))]
+
+
+def log_prob(engine, z, target, scale, batch_size=65536):
+    """NB log-likelihoods of all heads (lists of targets/scales, one per head), in batches under torch.inference_mode"""
+    with torch.inference_mode():
+        chunks = [
+            engine.log_prob(z[start:start + batch_size],
+                            [t[start:start + batch_size] for t in target],
+                            [s[start:start + batch_size] for s in scale])
+            for start in range(0, len(z), batch_size)
+        ]
+    return [torch.cat([chunk[i] for chunk in chunks]) for i in range(len(chunks[0]))]
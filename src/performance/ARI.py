@@ -1,28 +1,22 @@
+import pandas as pd
 from sklearn.metrics.cluster import rand_score, adjusted_rand_score
 
 
-def calculate_rand(dgd_rep, data_loader):
+def calculate_rand(dgd, dgd_rep, data_loader, chunk_size=65536):
+   """
+   Adjusted rand index between the class labels and the GMM clusters of the representations,
+   each cluster named after its most frequent label.
 
-   labels = data_loader.dataset.label
-
-   clustering = []
-
-   
+   usage:
+   print(calculate_rand(dgd, dgd.train_rep, train_loader))
+   """
+   dataset = data_loader.dataset
+   labels = dataset.labels if hasattr(dataset, "labels") else dataset.label
 
    df = pd.DataFrame(labels, columns=["label"])
 
-   
-
-   rep = dgd_rep
-
-   for i in range(len(rep.z)):
-
-       cluster = dgd.gmm.clustering(rep(i)).unsqueeze(0).detach().cpu().numpy()
-
-       clustering.extend(cluster)
-
-   df["cluster"] = clustering
-
+   # all representations are assigned in chunks, instead of one gmm call per sample
+   df["cluster"] = dgd.gmm.clustering(dgd_rep.z.detach(), chunk_size=chunk_size).numpy()
    df["cluster"] = df["cluster"].astype('category')
 
 
@@ -39,7 +33,3 @@ def calculate_rand(dgd_rep, data_loader):
 
 
    return rand_index
-
-usage:
-
-print(calculate_rand(dgd.train_rep, train_loader))
\ No newline at end of file
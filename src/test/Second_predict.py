@@ -1,6 +1,6 @@
 import torch
-from tqdm import tqdm
 from src.dgd.latent import RepresentationLayer
+from src.test.init_reps import initial_representations, fit_representations, rep_optimizer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -21,13 +21,18 @@ def learn_new_representation(dgd,
                              weight_decay=0.,
                              betas=(0.5, 0.7),
                              reduction_type="sum",
-                             resampling_type="mean"):
+                             resampling_type="mean",
+                             tolerance=None,
+                             n_new_samples=1,
+                             top_k=1,
+                             multi_start_epochs=5):
     """
     This function learns a new representation layer for the DGD.
     The new representation layer is learned by sampling new points
     from the GMMs and finding the best fitting GMM for each sample.
     The new representation layer is then optimized to minimize the
     reconstruction loss of the DGD.
+    test_epochs, tolerance, n_new_samples, top_k, multi_start_epochs: see initial_representations in src/test/init_reps.py.
     """
     def check_devices(**tensors):
         for name, t in tensors.items():
@@ -39,62 +44,63 @@ def learn_new_representation(dgd,
     gmm_loss = True
     
     n_samples_new = len(data_loader.dataset)
-    potential_reps = dgd.gmm.sample_new_points(resampling_type).to(device) # initialize reps. One mean value per component. Remove the list wrapper.
+    potential_reps = dgd.gmm.sample_new_points(resampling_type, n_new_samples=n_new_samples).to(device) # initialize reps. One mean value (or n_new_samples samples) per component. Remove the list wrapper.
     #print("potential_reps device:", potential_reps.device) # added
     #print(potential_reps)
     #print(len(potential_reps))
 
     dgd.eval() # evaluation mode
-    X_test = dgd.decoder(potential_reps.to(device)) # reconstructed data
-    X_test = X_test[0]
-    #print(X_test)
-    #print(len(X_test))
+    with torch.no_grad():
+        X_test = dgd.decoder(potential_reps.to(device))[0] # reconstructed data, one row per potential rep (decoded once)
 
-    rep_init_values = torch.zeros((n_samples_new, potential_reps.shape[-1]), device=device) # added device
-    #print("rep_init_values device:", rep_init_values.device) # added
-    # check_devices(rep_init_values=rep_init_values, potential_reps=potential_reps)
-    
-    #count = 0
-    # this first loop is for initialization of the representations
-    for (mut_data, lib, i) in tqdm(data_loader.dataset): # loop through samples
-        loss = torch.empty(0).to(device) # placed on the same hardware for computations
-        for X in X_test:   # loop through each reconstruction, determined by the number of GMM components chosen
-            mut_recon_loss = dgd.decoder.loss(
-                nn_output=[X.to(device)], # added wrapping
-                target=[mut_data.to(device)], 
-                scale=[lib],
-                feature_ids=None, 
-                reduction="sum"
-            )
-            #print(mut_recon_loss)
-            #print(mut_recon_loss.shape)
-            loss = torch.cat((loss, mut_recon_loss.unsqueeze(0))) # add the reconstruction loss of representation X to the 1D tensor of losses.
-        best_fit_ids = torch.argmin(loss, dim=-1).detach() # removed .cpu()
-        #print(best_fit_ids)
-        rep_init_values[i, :] = potential_reps.clone()[best_fit_ids, :]
-        #count += 1
-        #print(count)
-    #print(rep_init_values)
+    def score(candidates, batch): # losses of every reconstruction against every sample of a batch, (n_candidates, batch size)
+        mut_data, lib, i = batch
+        mut_recon_loss = dgd.decoder.loss(
+            nn_output=candidates.unsqueeze(1), # (n_candidates, 1, features) broadcast against (batch size, features)
+            target=mut_data.to(device),
+            scale=lib.to(device).view(1, -1, 1),
+            mod_id=0,
+            reduction="none"
+        )
+        return mut_recon_loss.sum(-1), i
+
+    def row_losses(z, batch): # reconstruction losses for z with n reps per sample of the batch (rep-major), (n, batch size)
+        mut_data, lib, i = batch
+        n = len(z) // len(mut_data)
+        mut_recon_loss = dgd.decoder.loss(
+            nn_output=dgd.decoder(z)[0],
+            target=mut_data.to(device).repeat(n, 1),
+            scale=lib.to(device).repeat(n).unsqueeze(1),
+            mod_id=0,
+            reduction="none"
+        )
+        return mut_recon_loss.sum(-1).view(n, len(mut_data))
+
+    def batch_loss(rep, batch):
+        mut_data, lib, index = batch
+        mut_recon_loss, rep_gmm_loss = dgd.forward_and_loss(
+            z=rep(index).to(device),
+            target=[mut_data.to(device)],
+            scale=lib.unsqueeze(1).to(device), # dimensional alignment with unsqueeze
+            gmm_loss=gmm_loss,
+            reduction=reduction_type
+        )
+        return mut_recon_loss + rep_gmm_loss
+
+    make_optimizer = lambda params, tolerance=None: rep_optimizer(params, tolerance, lr=learning_rates, weight_decay=weight_decay, betas=betas) # AdamW unless samples are frozen
+
+    # this first pass is for initialization of the representations: all reconstructions are scored against a whole batch at once
+    # and the best potential rep is picked per sample on the device
+    rep_init_values = initial_representations(dgd.gmm, potential_reps, score, batch_loss, row_losses, data_loader, n_samples_new,
+                                              make_optimizer, top_k=top_k, n_epochs=multi_start_epochs, scored=X_test, max_rows=2**14)
 
     Ntest=len(data_loader.dataset)
     new_rep = RepresentationLayer(n_rep=dgd.rep_dim, # set-up the representation layer with the best values found above
                                   n_sample=Ntest,
                                   value_init=rep_init_values).to(device)
-    
-    test_rep_optimizer = torch.optim.AdamW(new_rep.parameters(), lr=learning_rates, weight_decay=weight_decay, betas=betas) # set-up optimizer
-    
-    for epoch in tqdm(range(test_epochs)): # loop through epochs for a progress bar #tqdm()
-        test_rep_optimizer.zero_grad()
-        for (mut_data, lib, index) in data_loader: # loop through samples
-            mut_recon_loss, gmm_loss = dgd.forward_and_loss(
-                z=new_rep(index).to(device),
-                target=[mut_data.to(device)],
-                scale=lib.unsqueeze(1).to(device), # dimensional alignment with unsqueeze
-                gmm_loss=gmm_loss,
-                reduction=reduction_type
-            )
-            loss = mut_recon_loss + gmm_loss
-            loss.backward()
-        test_rep_optimizer.step() # updating the rep for each epoch
+
+    # at most test_epochs epochs, converged samples (tolerance) are frozen and left out of the later epochs
+    fit_representations(new_rep, lambda batch: batch_loss(new_rep, batch), data_loader, make_optimizer(new_rep.parameters(), tolerance),
+                        max_epochs=test_epochs, tolerance=tolerance)
     
     return new_rep 
\ No newline at end of file
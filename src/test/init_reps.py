@@ -0,0 +1,186 @@
+import torch
+from tqdm import tqdm
+from src.data.flat_dataset import sample_loader
+from src.dgd.latent import RepresentationLayer
+from src.dgd.optim import RowAdamW
+
+def best_candidates(score, candidates, loader, n_samples, max_rows=2**20):
+    """
+    Batched initialization for learn_new_representation: picks for every sample the candidate
+    (e.g. one of the GMM component means, or its decoded output) with the lowest loss summed over all rows of that sample.
+
+    Instead of one decoder forward per candidate and batch, score() evaluates a block of candidates
+    against all rows of a batch at once (one K x B evaluation); the losses are summed per sample with
+    index_add_ (a segment sum over sample_idx) and the argmin is taken on the device after a single pass.
+
+    Args:
+        score: function (candidates, batch) -> (losses of shape (n_candidates, batch rows), sample index of each row)
+        candidates: (n_candidates, ...) tensor on the device used for scoring
+        loader: the test data loader
+        n_samples: number of samples (the range of the sample indices)
+        max_rows: maximum number of candidate x row pairs evaluated at once; the candidates are split into blocks
+
+    Returns:
+        the index of the best candidate per sample (n_samples,) and the summed losses (n_candidates, n_samples)
+    """
+    device = candidates.device
+    total = torch.zeros((len(candidates), n_samples), device=device)
+    with torch.no_grad():
+        for batch in loader:
+            block = max(1, max_rows // len(batch[0]))
+            for start in range(0, len(candidates), block):
+                loss, sample_idx = score(candidates[start:start + block], batch)
+                total[start:start + block].index_add_(1, torch.as_tensor(sample_idx, device=device), loss)
+    return torch.argmin(total, dim=0), total
+
+
+def expand_candidates(candidates, n_rows):
+    """(n_candidates, dim) -> (n_candidates * n_rows, dim), candidate-major, to pair every candidate with every row"""
+    return candidates.unsqueeze(1).expand(-1, n_rows, -1).reshape(len(candidates) * n_rows, -1)
+
+
+def fit_representations(rep, batch_loss, loader, optimizer, max_epochs=50, tolerance=None):
+    """
+    Test-time optimization of the representations in rep: one optimizer step per epoch on the loss summed over
+    all batches of the loader (as in learn_new_representation), with per-sample convergence tracking.
+
+    After every epoch the gradient norm of each representation row is checked; samples below the tolerance are
+    frozen, and the following epochs only iterate over the rows of the samples that are still active.
+    The decoder and the mutation reps are fixed at test time, so every sample's loss only depends on its own
+    representation and the frozen samples do not change the optimization of the others.
+    With a tolerance, use an optimizer that leaves rows without gradient untouched (RowAdamW, see rep_optimizer),
+    torch.optim.AdamW would keep moving the frozen rows with its momentum and weight decay.
+
+    Args:
+        rep: RepresentationLayer being optimized
+        batch_loss: function batch -> scalar loss of the batch
+        loader: the test data loader (DataLoader or ResidentLoader, see sample_loader)
+        optimizer: optimizer over rep's parameters
+        max_epochs: maximum number of epochs
+        tolerance: gradient norm below which a sample counts as converged; None runs all max_epochs on all samples
+
+    Returns:
+        number of epochs each sample was optimized for, shape (n_samples,)
+    """
+    n_samples = rep.z.shape[0]
+    active = torch.ones(n_samples, dtype=torch.bool, device=rep.z.device)
+    epochs = torch.full((n_samples,), max_epochs, dtype=torch.long, device=rep.z.device)
+    active_loader = loader
+    for epoch in tqdm(range(max_epochs)): # loop through epochs for a progress bar
+        optimizer.zero_grad()
+        for batch in active_loader:
+            batch_loss(batch).backward()
+        optimizer.step() # updating the rep for each epoch
+        if tolerance is None:
+            continue
+        converged = active & (rep.z.grad.norm(dim=-1) < tolerance)
+        if converged.any():
+            active &= ~converged
+            epochs[converged] = epoch + 1
+            if not active.any():
+                break
+            active_loader = sample_loader(loader, torch.nonzero(active).squeeze(1)) # only the rows of the active samples
+    return epochs
+
+
+def rep_optimizer(params, tolerance=None, **kwargs):
+    """
+    Optimizer for the test-time representations: torch.optim.AdamW when all samples are optimized for every epoch
+    (tolerance=None), RowAdamW when converged samples are frozen, so their rows keep their values.
+    RowAdamW skips rows whose gradient is exactly zero, which would change the weight decay and step counts of the plain run.
+    kwargs (lr, weight_decay, betas) are passed on to the optimizer.
+    """
+    if tolerance is None:
+        return torch.optim.AdamW(params, **kwargs)
+    return RowAdamW(params, **kwargs)
+
+
+def expand_batch(batch, n_starts):
+    """
+    batch with every row repeated for n_starts representations per sample (start-major, like expand_candidates).
+    sample_idx is replaced by the row of the start in a table with n_starts consecutive rows per sample,
+    sample_idx * n_starts + j, so the batch can be used with a RepresentationLayer over all starts.
+    """
+    value, lib, sample_idx, *rest = batch
+    sample_idx = torch.as_tensor(sample_idx)
+    start_idx = (sample_idx.unsqueeze(0) * n_starts + torch.arange(n_starts, device=sample_idx.device).unsqueeze(1)).reshape(-1)
+    repeat = lambda t: t.repeat(n_starts, *[1] * (t.dim() - 1))
+    return (repeat(value), repeat(lib), start_idx, *[repeat(t) for t in rest])
+
+
+def multi_start(gmm, candidates, total, top_k, batch_loss, row_losses, loader, make_optimizer, n_epochs=5):
+    """
+    Multi-start initialization: keeps the top_k candidates per sample (lowest summed loss, see best_candidates),
+    optimizes all of them in parallel for a few epochs and returns the best one per sample.
+
+    The starts live in one RepresentationLayer with top_k consecutive rows per sample and every batch is
+    expanded to all starts of its samples (expand_batch), so each epoch is still one pass over the loader.
+    The loss is summed over the starts, which share no rows, so every start is optimized on its own.
+    The final choice uses the objective the starts were optimized on: the summed reconstruction loss plus
+    the GMM term gmm(z) of every row (as in DGD.loss), so a start cannot win by drifting into a low-prior region.
+    top_k is clamped to the number of candidates (e.g. the n_mix_comp means with resampling_type='mean').
+
+    Args:
+        gmm: GaussianMixture of the sample representations (dgd.gmm)
+        candidates: (n_candidates, rep_dim) candidate representations
+        total: (n_candidates, n_samples) summed losses from best_candidates
+        top_k: number of starts kept per sample
+        batch_loss: function (rep, batch) -> scalar loss of the batch for the representations in rep
+        row_losses: function (z, batch) -> (n, batch rows) losses for z with n rows per batch row (start-major)
+        loader: the test data loader
+        make_optimizer: function params -> optimizer (no samples are frozen here, see rep_optimizer)
+        n_epochs: number of epochs the starts are optimized for
+
+    Returns:
+        the best representation per sample, (n_samples, rep_dim)
+    """
+    n_samples = total.shape[1]
+    top_k = min(top_k, len(candidates))
+    top_ids = torch.topk(total, top_k, dim=0, largest=False).indices.T # (n_samples, top_k)
+    starts = RepresentationLayer(n_rep=candidates.shape[-1],
+                                 n_sample=n_samples * top_k,
+                                 value_init=candidates[top_ids.reshape(-1)].clone()).to(candidates.device)
+    fit_representations(starts, lambda batch: batch_loss(starts, expand_batch(batch, top_k)), loader,
+                        make_optimizer(starts.parameters()), max_epochs=n_epochs)
+
+    losses = torch.zeros(n_samples * top_k, device=candidates.device)
+    with torch.no_grad():
+        for batch in loader:
+            batch = expand_batch(batch, top_k)
+            start_idx = batch[2].to(candidates.device)
+            z = starts(start_idx)
+            losses.index_add_(0, start_idx, row_losses(z, batch).reshape(-1) + gmm(z).to(candidates.device))
+    best, _ = gmm.choose_best_representations(starts.z.detach(), losses.view(n_samples, top_k))
+    return best.clone()
+
+
+def initial_representations(gmm, candidates, score, batch_loss, row_losses, loader, n_samples, make_optimizer,
+                            top_k=1, n_epochs=5, scored=None, max_rows=2**20):
+    """
+    Initial representations for learn_new_representation (all variants in src/test), whose test-time options are:
+        resampling_type, n_new_samples: the candidates are dgd.gmm.sample_new_points(resampling_type, n_new_samples),
+            one mean (or n_new_samples samples) per GMM component
+        top_k, multi_start_epochs: with top_k > 1 the top_k candidates of every sample are optimized in parallel
+            for multi_start_epochs epochs and the best one is kept (multi_start), otherwise the best candidate is used
+        test_epochs, tolerance: the initial representations are then optimized for at most test_epochs epochs,
+            samples whose gradient norm drops below the tolerance are frozen (fit_representations, rep_optimizer)
+
+    Args:
+        gmm, batch_loss, row_losses, loader, make_optimizer: see multi_start
+        candidates: (n_candidates, rep_dim) candidate representations
+        score: function (scored block, batch) -> (losses, sample index of each row), see best_candidates
+        n_samples: number of samples
+        top_k: number of starts kept per sample
+        n_epochs: number of epochs the starts are optimized for
+        scored: what score() is evaluated on, e.g. the decoded candidates; defaults to candidates
+        max_rows: see best_candidates
+
+    Returns:
+        the initial representation per sample, (n_samples, rep_dim)
+    """
+    if scored is None:
+        scored = candidates
+    best_fit_ids, total = best_candidates(score, scored, loader, n_samples, max_rows=max_rows)
+    if top_k > 1:
+        return multi_start(gmm, candidates, total, top_k, batch_loss, row_losses, loader, make_optimizer, n_epochs=n_epochs)
+    return candidates[best_fit_ids].clone()
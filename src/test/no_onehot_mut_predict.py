@@ -1,6 +1,6 @@
 import torch
-from tqdm import tqdm
 from src.dgd.latent import RepresentationLayer
+from src.test.init_reps import initial_representations, fit_representations, expand_candidates, rep_optimizer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -22,13 +22,18 @@ def learn_new_representation(dgd,
                              weight_decay=0.,
                              betas=(0.5, 0.7),
                              reduction_type="sum",
-                             resampling_type="mean"):
+                             resampling_type="mean",
+                             tolerance=None,
+                             n_new_samples=1,
+                             top_k=1,
+                             multi_start_epochs=5):
     """
     This function learns a new representation layer for the DGD.
     The new representation layer is learned by sampling new points
     from the GMMs and finding the best fitting GMM for each sample.
     The new representation layer is then optimized to minimize the
     reconstruction loss of the DGD.
+    test_epochs, tolerance, n_new_samples, top_k, multi_start_epochs: see initial_representations in src/test/init_reps.py.
     """
 
     gmm_loss = True
@@ -36,60 +41,58 @@ def learn_new_representation(dgd,
     
     Nsample=test_loader.dataset.num_samples
     
-    potential_reps = dgd.gmm.sample_new_points(resampling_type).to(device) # initialize reps. One mean value per component. Remove the list wrapper and prepare()
+    potential_reps = dgd.gmm.sample_new_points(resampling_type, n_new_samples=n_new_samples).to(device) # initialize reps. One mean value (or n_new_samples samples) per component. Remove the list wrapper and prepare()
 
     dgd.eval() # evaluation mode
 
 
-    rep_init_values = torch.zeros((Nsample, potential_reps.shape[-1]), device=device) # added device
-    #print(rep_init_values.shape)
-
     #Nmut=train_loader.dataset.num_muts
     mut_rep = dgd.mut_train_rep.z.to(device) # use the mut reps found in the training
     #print(mut_rep)
-    # this first loop is for initialization of the sample representations
-    for mut_data, lib, sample_idx, mut_idx in test_loader: # loop through batches
-        loss = torch.empty(0).to(device) # placed on the same hardware for computations
-        for rep in potential_reps:  # loop through each potential initial representation, determined by the number of GMM components             hosen
-            rep_batch = rep.unsqueeze(0).expand(len(mut_idx), -1).to(device) # giving the potential rep the same batch dimension as the             rest of the data
-            X = dgd.forward(rep_batch,mut_rep[mut_idx].to(device)) # forward instead of decoder, as it combines the three input types                before the forward pass for the final output.                The loss function in decoder.py
-            #print(X) # a tensor wrapped in a list
-            mut_recon_loss = dgd.decoder.loss( 
-                nn_output=X[0].to(device), # unwrap bc decoder outputs a list of output modules, and I only use one modality
-                target=mut_data.to(device), 
-                scale=lib.to(device),
-                feature_ids=None, 
-                reduction="mean" # sum or mean? both makes sense
-            )
-            loss = torch.cat((loss, mut_recon_loss.unsqueeze(0))) # add the reconstruction loss of representation X to the 1D tensor of               losses
-        best_fit_ids = torch.argmin(loss, dim=-1).detach() # removed .cpu()
-        rep_init_values[sample_idx[0], :] = potential_reps.clone()[best_fit_ids, :] # take the sample index once, not the whole list of          the same index, bc we only want one rep per sample           not one per row
-        #print(rep_init_values) # looks right, 374 prints (batches)
+
+    def row_losses(z, batch): # reconstruction losses for z with n reps per batch row (rep-major), (n, batch rows)
+        mut_data, lib, sample_idx, mut_idx = batch
+        mut_idx = mut_idx.to(device)
+        n, n_rows = len(z) // len(mut_idx), len(mut_idx)
+        X = dgd.forward(z, mut_rep[mut_idx].repeat(n, 1))
+        mut_recon_loss = dgd.decoder.loss(
+            nn_output=X[0], # unwrap bc decoder outputs a list of output modules, and I only use one modality
+            target=mut_data.to(device).repeat(n, 1),
+            scale=lib.to(device).repeat(n, 1),
+            mod_id=0,
+            reduction="none"
+        )
+        return mut_recon_loss.view(n, n_rows)
+
+    def score(candidates, batch): # losses of every candidate rep against every row of a batch, (n_candidates, batch rows)
+        return row_losses(expand_candidates(candidates, len(batch[0])), batch), batch[2] # candidate-major: rows [k*B, (k+1)*B) belong to candidate k
+
+    def batch_loss(rep, batch):
+        mut_data, lib, sample_idx, mut_idx = batch
+        mut_recon_loss, rep_gmm_loss, rep_mut_gmm_loss = dgd.forward_and_loss(
+            z=rep(sample_idx).to(device),
+            mut_z=mut_rep[mut_idx].to(device), # standard indexing bc it's a torch.nn.Parameter
+            target=[mut_data.to(device)],
+            scale=lib.unsqueeze(1).to(device), # dimensional alignment with unsqueeze
+            gmm_loss=gmm_loss,
+            mut_gmm_loss=mut_gmm_loss,
+            reduction=reduction_type
+        )
+        return mut_recon_loss + rep_gmm_loss + rep_mut_gmm_loss
+
+    make_optimizer = lambda params, tolerance=None: rep_optimizer(params, tolerance, lr=learning_rates, weight_decay=weight_decay, betas=betas) # AdamW unless samples are frozen
+
+    # this first pass is for initialization of the sample representations: every potential rep
+    # is scored against all rows of a batch in one decoder call, the losses are summed per sample and the best rep is picked per sample
+    rep_init_values = initial_representations(dgd.gmm, potential_reps, score, batch_loss, row_losses, test_loader, Nsample,
+                                              make_optimizer, top_k=top_k, n_epochs=multi_start_epochs)
     
-    #print("Expected shape:", (Nsample, dgd.rep_dim))
-    #print("value_init shape:", rep_init_values.shape)
     new_rep = RepresentationLayer(n_rep=dgd.rep_dim, # set-up the representation layer with the best values found above
                                   n_sample=Nsample,
                                   value_init=rep_init_values).to(device)
-    
-    test_rep_optimizer = torch.optim.AdamW(new_rep.parameters(), lr=learning_rates, weight_decay=weight_decay, betas=betas) # set-up optimizer
-    
-    for epoch in tqdm(range(test_epochs)): # loop through epochs for a progress bar #tqdm()
-        test_rep_optimizer.zero_grad()
-        for mut_data, lib, sample_idx, mut_idx in test_loader: # loop through samples
-            #print(new_rep(sample_idx))
-            #print(mut_rep[mut_idx])
-            mut_recon_loss, gmm_loss, mut_gmm_loss = dgd.forward_and_loss(
-                z=new_rep(sample_idx).to(device),
-                mut_z=mut_rep[mut_idx].to(device), # standard indexing bc it's a torch.nn.Parameter
-                target=[mut_data.to(device)],
-                scale=lib.unsqueeze(1).to(device), # dimensional alignment with unsqueeze
-                gmm_loss=gmm_loss,
-                mut_gmm_loss=mut_gmm_loss,
-                reduction=reduction_type
-            )
-            loss = mut_recon_loss + gmm_loss + mut_gmm_loss
-            loss.backward()
-        test_rep_optimizer.step() # updating the rep for each epoch
+
+    # at most test_epochs epochs, converged samples (tolerance) are frozen and left out of the later epochs
+    fit_representations(new_rep, lambda batch: batch_loss(new_rep, batch), test_loader, make_optimizer(new_rep.parameters(), tolerance),
+                        max_epochs=test_epochs, tolerance=tolerance)
     
     return new_rep 
\ No newline at end of file
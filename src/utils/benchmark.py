@@ -0,0 +1,772 @@
+import copy
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from src.data.flat_dataset import FlattenedDataset, batch_loader, without_onehot
+from src.data.resident_loader import ResidentLoader
+from src.data.sparse_flat_dataset import SparseFlattenedDataset
+from src.data.maf_pipeline import MAF_COLUMNS, OUT_COLUMNS, annotate_maf
+from src.model.decoder import Decoder
+from src.model.inference import export_decoder, load_decoder
+from src.dgd.nn import NB_Module, logNBdensity, fused_logNBdensity
+from src.dgd.latent import GaussianMixture, GaussianMixtureSupervised, RepresentationLayer, SparseRepresentationLayer
+from src.dgd.optim import RowAdamW
+from src.test.init_reps import best_candidates, expand_candidates, fit_representations, multi_start, rep_optimizer
+
+# Small timing helpers (and parity checks) used to compare the data and model code paths on synthetic data.
+# Run all benchmarks with: python -m src.utils.benchmark
+
+def synthetic_counts(n_samples=200, n_tumor_types=5, density=0.2, seed=1):
+    """
+    Creates a dataframe shaped like to_dgd.parquet: one row per donor, one column per
+    mutation context (e.g. AC[C>T]GA) with sparse Poisson counts, and a last Tumor_Type column.
+    """
+    rng = np.random.default_rng(seed)
+    bases = ['A', 'C', 'G', 'T']
+    kmers = [
+        f"{l1}{l2}[{ref}>{alt}]{r1}{r2}"
+        for ref, alts in (('C', 'AGT'), ('T', 'ACG'))
+        for alt in alts
+        for l1 in bases for l2 in bases for r1 in bases for r2 in bases
+    ]
+    counts = rng.poisson(3.0, size=(n_samples, len(kmers)))
+    counts[rng.random(counts.shape) > density] = 0
+    df = pd.DataFrame(counts, columns=kmers, index=[f"DO{i}" for i in range(n_samples)])
+    df['Tumor_Type'] = rng.choice([f"Type-{i}" for i in range(n_tumor_types)], size=n_samples)
+    return df
+
+
+def rows_per_second(loader, n_batches=None):
+    """iterate over a loader and return the number of flattened rows produced per second"""
+    n_rows = 0
+    start = time.perf_counter()
+    for i, batch in enumerate(loader):
+        n_rows += len(batch[0])
+        if n_batches is not None and i + 1 >= n_batches:
+            break
+    return n_rows / (time.perf_counter() - start)
+
+
+def benchmark_flat_loader(df=None, batch_size=1536, n_batches=100):
+    """rows/sec of the per-row DataLoader path vs. the batched get_batch path"""
+    if df is None:
+        df = synthetic_counts()
+    dataset = FlattenedDataset(df, scaling_type='mean')
+    per_row = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    batched = batch_loader(dataset, batch_size=batch_size, shuffle=True)
+    return {
+        'per_row': rows_per_second(per_row, n_batches),
+        'batched': rows_per_second(batched, n_batches),
+    }
+
+
+def benchmark_resident_loader(df=None, batch_size=1536, n_batches=100, device=None):
+    """rows/sec of the batched DataLoader path (+ copy to device) vs. the device-resident loader"""
+    if df is None:
+        df = synthetic_counts()
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = FlattenedDataset(df, scaling_type='mean')
+
+    def to_device(loader):
+        for batch in loader:
+            yield [b.to(device) for b in batch]
+
+    batched = batch_loader(dataset, batch_size=batch_size, shuffle=True)
+    resident = ResidentLoader(dataset, batch_size=batch_size, shuffle=True, device=device)
+    return {
+        'batched': rows_per_second(to_device(batched), n_batches),
+        'resident': rows_per_second(resident, n_batches),
+    }
+
+
+def benchmark_onehot_transfer(df=None, batch_size=1536, n_batches=100, device=None):
+    """
+    bytes per batch shipped by the test loader, and rows/sec including the copy to the device,
+    with the collated onehot vs. without it (without_onehot, the encodings are gathered on the device)
+    """
+    if df is None:
+        df = synthetic_counts()
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    loader = batch_loader(FlattenedDataset(df, scaling_type='mean'), batch_size=batch_size)
+
+    def to_device(loader):
+        for batch in loader:
+            yield [b.to(device) for b in batch]
+
+    result = {}
+    for name, test_loader in (('onehot', loader), ('no_onehot', without_onehot(loader))):
+        batch = next(iter(test_loader))
+        result[f'{name}_bytes_per_batch'] = sum(torch.as_tensor(b).element_size() * torch.as_tensor(b).numel() for b in batch)
+        result[f'{name}_rows_per_sec'] = rows_per_second(to_device(test_loader), n_batches)
+    return result
+
+
+def benchmark_sparse_dataset(df=None, zero_fraction=0.1):
+    """storage (MB) and rows per epoch of the dense FlattenedDataset vs. the CSR-backed SparseFlattenedDataset"""
+    if df is None:
+        df = synthetic_counts(density=0.05)
+    dense = FlattenedDataset(df, scaling_type='mean')
+    sparse = SparseFlattenedDataset(df, scaling_type='mean', zero_fraction=zero_fraction, seed=1)
+    mb = lambda *tensors: sum(t.element_size() * t.numel() for t in tensors) / 2**20
+    return {
+        'dense_MB': mb(dense.mut_matrix),
+        'sparse_MB': mb(sparse.crow, sparse.col, sparse.values, sparse.nz_flat),
+        'dense_rows': len(dense),
+        'sparse_rows': len(sparse),
+    }
+
+
+def synthetic_maf(n_rows=5000, n_samples=30, seed=1):
+    """
+    Dataframes shaped like signature.sort.maf.bed and donor_labels.tsv: a mix of chromosomes (incl. chrX/chrY),
+    variant classes and types, duplicated positions, lower-case contexts, empty snpOverlap/byFrequency
+    fields, and a few samples without a donor label.
+    """
+    rng = np.random.default_rng(seed)
+    bases = np.array(list('ACGTacgt'))
+    classes = ["3'UTR", "5'Flank", 'IGR', 'Intron', 'lincRNA', 'RNA', 'Missense_Mutation', 'Silent']
+    samples = np.array([f"SA{i}" for i in range(n_samples)])
+
+    start = rng.integers(1, 2000, size=n_rows) # small range, so positions repeat
+    maf = pd.DataFrame({c: rng.random(n_rows).round(3).astype(str) for c in MAF_COLUMNS})
+    maf['Chromosome'] = rng.choice(['chr1', 'chr2', 'chr10', 'chrX', 'chrY'], size=n_rows)
+    maf['Start_position'] = start.astype(str)
+    maf['End_position'] = (start + 1).astype(str)
+    maf['Strand'] = '+'
+    maf['Variant_Classification'] = rng.choice(classes, size=n_rows)
+    maf['Variant_Type'] = rng.choice(['SNP', 'SNP', 'SNP', 'DNP'], size=n_rows)
+    maf['Reference_Allele'] = rng.choice(bases[:4], size=n_rows)
+    maf['maja'] = rng.choice(bases[:4], size=n_rows)
+    maf['Tumor_Seq_Allele2'] = rng.choice(bases, size=n_rows)
+    maf['snpOverlap'] = rng.choice(['', 'rs1', ' '], size=n_rows)
+    maf['byFrequency'] = rng.choice(['', '0.1'], size=n_rows)
+    maf['sample'] = rng.choice(samples, size=n_rows)
+    maf['normid'] = 'N1'
+    maf['posAndType'] = 'pos'
+    maf['ref_context'] = [''.join(row) for row in rng.choice(bases, size=(n_rows, 21))]
+
+    labelled = samples[:-3]
+    donors = pd.DataFrame({
+        'Donor_ID': [f"DO{i}" for i in range(len(labelled))],
+        'Tumor_Type': rng.choice(['Liver-HCC', 'Skin-Melanoma'], size=len(labelled)),
+        'colcode': '#000000',
+        'sample': labelled,
+        'project_code': 'PRJ',
+    })
+    return maf, donors
+
+
+def maf_pipeline_parity(workdir=None, n_rows=5000):
+    """
+    Run Scripts/datamaf_pipeline.sh and src/data/maf_pipeline.py on the same synthetic MAF and compare
+    the outputs (as sorted rows, since the shell version sorts by sample id).
+    Raises an AssertionError naming the differing columns and rows if the outputs differ (see assert_same_frame).
+    Returns the timings.
+    """
+    workdir = workdir or tempfile.mkdtemp()
+    script = os.path.join(os.path.dirname(__file__), '..', '..', 'Scripts', 'datamaf_pipeline.sh')
+    maf, donors = synthetic_maf(n_rows)
+    os.makedirs(os.path.join(workdir, 'PCAWG_donorinfo'), exist_ok=True)
+    maf.to_csv(os.path.join(workdir, 'signature.sort.maf.bed'), sep='\t', header=False, index=False)
+    donors.to_csv(os.path.join(workdir, 'PCAWG_donorinfo', 'donor_labels.tsv'), sep='\t', header=False, index=False)
+
+    start = time.perf_counter()
+    subprocess.run(['bash', os.path.abspath(script)], cwd=workdir, check=True, capture_output=True,
+                   env={**os.environ, 'LC_ALL': 'C'})
+    shell_time = time.perf_counter() - start
+    start = time.perf_counter()
+    annotate_maf(os.path.join(workdir, 'signature.sort.maf.bed'),
+                 os.path.join(workdir, 'PCAWG_donorinfo', 'donor_labels.tsv'),
+                 os.path.join(workdir, 'annotated.parquet'), chunksize=1000)
+    python_time = time.perf_counter() - start
+
+    # the shell output has no project_code values (dropped by its cut -f2-84)
+    columns = OUT_COLUMNS[:-1]
+    shell = pd.read_csv(os.path.join(workdir, 'signature_snv_filtered_annotated4.tsv'), sep='\t',
+                        dtype=str, keep_default_na=False)[columns]
+    python = pd.read_parquet(os.path.join(workdir, 'annotated.parquet'))[columns].astype(str)
+    sort = lambda df: df.sort_values(columns).reset_index(drop=True)
+    assert_same_frame(sort(shell), sort(python), names=('shell', 'python'))
+    return {
+        'shell_sec': shell_time,
+        'python_sec': python_time,
+    }
+
+
+def assert_same_frame(expected, actual, names=('expected', 'actual'), max_rows=5):
+    """
+    Raise an AssertionError if two dataframes differ, listing the missing/extra columns, a row count
+    mismatch, or the columns with differing values and the first max_rows differing rows.
+    """
+    problems = []
+    missing = [c for c in expected.columns if c not in actual.columns]
+    extra = [c for c in actual.columns if c not in expected.columns]
+    if missing or extra:
+        problems.append(f"columns only in {names[0]}: {missing}, only in {names[1]}: {extra}")
+    if len(expected) != len(actual):
+        problems.append(f"{len(expected)} rows in {names[0]}, {len(actual)} rows in {names[1]}")
+    if not problems:
+        diff = expected.ne(actual[expected.columns])
+        columns = diff.columns[diff.any(axis=0)].tolist()
+        if columns:
+            rows = np.flatnonzero(diff.any(axis=1).values)
+            problems.append(f"values differ in columns {columns} for {len(rows)} rows, first rows:\n"
+                            + pd.concat({names[0]: expected.loc[rows[:max_rows], columns],
+                                         names[1]: actual.loc[rows[:max_rows], columns]}, axis=1).to_string())
+    if problems:
+        raise AssertionError("\n".join(problems))
+
+
+def factorized_decoder_parity(n_samples=200, n_muts=1536, rep_dim=20, mut_rep_dim=10, onehot_dim=24,
+                              hidden_dims=[100, 100], batch_size=1536, n_batches=20, seed=1):
+    """
+    Max abs. difference and time per batch of the first decoder layer on torch.cat((z, mut_z, onehot))
+    vs. the factorized input (same weights), on random flattened batches.
+    """
+    torch.manual_seed(seed)
+    sizes = [rep_dim, mut_rep_dim, onehot_dim]
+    decoder = Decoder(sum(sizes), hidden_dims, [], input_split=sizes)
+    reps = torch.randn(n_samples, rep_dim)
+    mut_reps = torch.randn(n_muts, mut_rep_dim)
+    context = torch.randint(0, 2, (n_muts, onehot_dim)).float()
+    layer = decoder.main[0]
+
+    max_diff, concat_time, factorized_time = 0., 0., 0.
+    with torch.no_grad():
+        for _ in range(n_batches):
+            sample_idx = torch.randint(n_samples, (batch_size,))
+            mut_idx = torch.randint(n_muts, (batch_size,))
+            start = time.perf_counter()
+            dense = layer(torch.cat((reps[sample_idx], mut_reps[mut_idx], context[mut_idx]), dim=1))
+            concat_time += time.perf_counter() - start
+            start = time.perf_counter()
+            factorized = layer.forward_parts([(reps, sample_idx), (mut_reps, mut_idx), (context, mut_idx)])
+            factorized_time += time.perf_counter() - start
+            max_diff = max(max_diff, (dense - factorized).abs().max().item())
+    return {
+        'max_abs_diff': max_diff,
+        'concat_ms': 1000 * concat_time / n_batches,
+        'factorized_ms': 1000 * factorized_time / n_batches,
+    }
+
+
+def grid_decoding_parity(n_samples=100, n_muts=1536, rep_dim=20, mut_dim=34, hidden_dims=[100, 100],
+                         batch_size=1536, memory_budget=2**26, seed=1):
+    """
+    Max abs. difference and time of the full sample x mutation grid (means and NB log-probs)
+    from flattened DGD-style batches vs. Decoder.decode_grid.
+    """
+    torch.manual_seed(seed)
+    out = NB_Module(nn.Sequential(nn.Linear(hidden_dims[-1], 1)), 1, scaling_type="mean")
+    decoder = Decoder(rep_dim + mut_dim, hidden_dims, [out])
+    reps = torch.randn(n_samples, rep_dim)
+    mut_inputs = torch.randn(n_muts, mut_dim)
+    target = torch.poisson(torch.full((n_samples, n_muts), 2.))
+    scale = target.mean(dim=1, keepdim=True)
+
+    start = time.perf_counter()
+    mean, log_prob = torch.empty(n_samples * n_muts), torch.empty(n_samples * n_muts)
+    with torch.no_grad():
+        for b in range(0, n_samples * n_muts, batch_size):
+            flat = torch.arange(b, min(b + batch_size, n_samples * n_muts))
+            sample_idx, mut_idx = flat // n_muts, flat % n_muts
+            y = decoder(torch.cat((reps[sample_idx], mut_inputs[mut_idx]), dim=1))[0]
+            mean[flat] = (scale[sample_idx] * y).squeeze(1)
+            log_prob[flat] = out.log_prob(y, target.view(-1, 1)[flat], scale[sample_idx]).squeeze(1)
+    flat_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = decoder.decode_grid(reps, mut_inputs, target=target, scale=scale, memory_budget=memory_budget)
+    grid_time = time.perf_counter() - start
+    return {
+        'max_abs_diff_mean': (grid['mean'].view(-1) - mean).abs().max().item(),
+        'max_abs_diff_log_prob': (grid['log_prob'].view(-1) - log_prob).abs().max().item(),
+        'flat_sec': flat_time,
+        'grid_sec': grid_time,
+    }
+
+
+def _broadcast_component_log_prob(gmm, x):
+    """the previous GaussianMixture scoring, with the (n_sample, n_mix_comp, dim) intermediate"""
+    y = -(x.unsqueeze(-2) - gmm.mean).square().div(2 * gmm.covariance).sum(-1)
+    y = y - gmm._log_var_factor * gmm.log_var.sum(-1)
+    y = y + gmm._pi_term
+    return y + torch.log_softmax(gmm.weight, dim=0)
+
+
+def benchmark_gmm_forward(n_sample=100000, n_mix_comp=64, dim=20, n_repeats=5, device=None, seed=1):
+    """
+    Max abs. difference and time per call of the broadcast GMM scoring vs. the matmul-based
+    GaussianMixture._component_log_prob, for each covariance type.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(seed)
+    result = {}
+    for covariance_type in ['fixed', 'isotropic', 'diagonal']:
+        gmm = GaussianMixture(n_mix_comp, dim, covariance_type=covariance_type).to(device)
+        with torch.no_grad():
+            gmm.log_var.add_(0.3 * torch.randn_like(gmm.log_var))
+        x = gmm.sample(n_sample).to(device)
+        with torch.no_grad():
+            timings = []
+            for fn in (_broadcast_component_log_prob, GaussianMixture._component_log_prob):
+                fn(gmm, x) # warm-up
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(n_repeats):
+                    y = fn(gmm, x)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                timings.append((time.perf_counter() - start) / n_repeats)
+            diff = (_broadcast_component_log_prob(gmm, x) - gmm._component_log_prob(x)).abs().max().item()
+        result[f'{covariance_type}_max_abs_diff'] = diff
+        result[f'{covariance_type}_broadcast_ms'] = 1000 * timings[0]
+        result[f'{covariance_type}_matmul_ms'] = 1000 * timings[1]
+    return result
+
+
+def benchmark_gmm_clustering(n_sample=20000, n_mix_comp=20, dim=20, chunk_size=65536, seed=1):
+    """
+    Time of the per-sample clustering loop (as ARI.py used to do) vs. one chunked call,
+    and whether the assignments agree.
+    """
+    torch.manual_seed(seed)
+    gmm = GaussianMixture(n_mix_comp, dim)
+    x = gmm.sample(n_sample)
+
+    start = time.perf_counter()
+    loop = torch.stack([gmm.clustering(x[i]) for i in range(n_sample)])
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    chunked = gmm.clustering(x, chunk_size=chunk_size)
+    chunked_time = time.perf_counter() - start
+    return {
+        'loop_sec': loop_time,
+        'chunked_sec': chunked_time,
+        'identical': float(torch.equal(loop, chunked)),
+    }
+
+
+def benchmark_supervised_gmm(n_sample=100000, n_class=20, n_comp_per_class=4, dim=20, n_repeats=5, seed=1):
+    """time per forward + backward of the unsupervised vs. the supervised (per-class gather) GMM loss"""
+    torch.manual_seed(seed)
+    gmm = GaussianMixtureSupervised(n_class, n_comp_per_class, dim)
+    x = gmm.sample(n_sample).requires_grad_()
+    label = torch.randint(n_class, (n_sample,))
+    result = {}
+    for name, args in (('unsupervised', ()), ('supervised', (label,))):
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            gmm(x, *args).sum().backward()
+        result[f'{name}_ms'] = 1000 * (time.perf_counter() - start) / n_repeats
+    return result
+
+
+def benchmark_representation_step(n_samples=(10000, 100000, 400000), rep_dim=20, batch_samples=256, n_steps=20, seed=1):
+    """
+    time per optimizer step of a dense RepresentationLayer + AdamW vs. a SparseRepresentationLayer + RowAdamW,
+    for growing cohorts and a fixed number of samples per batch
+    """
+    torch.manual_seed(seed)
+    result = {}
+    for n in n_samples:
+        for name, layer_cls, optim_cls in (('dense', RepresentationLayer, torch.optim.AdamW),
+                                           ('sparse', SparseRepresentationLayer, RowAdamW)):
+            rep = layer_cls(rep_dim, n)
+            optimizer = optim_cls(rep.parameters(), lr=1e-2, weight_decay=1e-4)
+            start = time.perf_counter()
+            for _ in range(n_steps):
+                idx = torch.randint(n, (batch_samples,))
+                optimizer.zero_grad()
+                rep(idx).square().sum().backward()
+                optimizer.step()
+            result[f'{name}_{n}_ms'] = 1000 * (time.perf_counter() - start) / n_steps
+    return result
+
+
+def benchmark_gmm_em(n_sample=20000, n_mix_comp=10, dim=20, batch_size=1000, em_every=5, tolerance=0.05,
+                     max_epochs=300, lr=1e-2, seed=1):
+    """
+    Epochs until the mean negative log density of fixed representations gets within tolerance of that
+    under the generating mixture, for a GMM trained with AdamW only vs. AdamW plus an em_update every em_every epochs.
+    """
+    torch.manual_seed(seed)
+    truth = GaussianMixture(n_mix_comp, dim)
+    with torch.no_grad():
+        truth.log_var.add_(0.5 * torch.randn_like(truth.log_var))
+    x = truth.sample(n_sample)
+    nll = lambda gmm: -gmm.sample_log_probs(x).logsumexp(-1).mean().item()
+    target = nll(truth) + tolerance
+
+    result = {}
+    for name, use_em in (('adamw', False), ('adamw_em', True)):
+        torch.manual_seed(seed + 1)
+        gmm = GaussianMixture(n_mix_comp, dim)
+        optimizer = torch.optim.AdamW(gmm.parameters(), lr=lr, weight_decay=0)
+        start = time.perf_counter()
+        epochs = max_epochs
+        for epoch in range(max_epochs):
+            if use_em and epoch % em_every == 0:
+                gmm.em_update(x)
+            for idx in torch.randperm(n_sample).split(batch_size):
+                optimizer.zero_grad()
+                gmm(x[idx]).mean().backward()
+                optimizer.step()
+            if nll(gmm) <= target:
+                epochs = epoch + 1
+                break
+        result[f'{name}_epochs'] = epochs
+        result[f'{name}_sec'] = time.perf_counter() - start
+    return result
+
+
+def benchmark_gmm_sampling(n_mix_comp=20, dim=20, n_new_samples=100, n_repeats=50, device=None, seed=1):
+    """
+    time per call of sample_new_points('sample') as before (torch.distributions rebuilt per call, cpu round-trip
+    and copy back to the device) vs. the cached device-native draw
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(seed)
+    gmm = GaussianMixture(n_mix_comp, dim).to(device)
+
+    def previous():
+        comp = torch.distributions.Independent(torch.distributions.Normal(gmm.mean, gmm.stddev), 1)
+        return comp.sample(torch.tensor([n_new_samples])).view(-1, dim).cpu().detach().to(device)
+
+    result = {}
+    with torch.no_grad():
+        for name, fn in (('previous', previous), ('device', lambda: gmm.sample_new_points('sample', n_new_samples))):
+            start = time.perf_counter()
+            for _ in range(n_repeats):
+                fn()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            result[f'{name}_ms'] = 1000 * (time.perf_counter() - start) / n_repeats
+    return result
+
+
+def benchmark_gmm_prior(n_mix_comp=20, dim=20, batch_size=1536, n_batches=200, accumulate=8, lr=1e-2, seed=1):
+    """
+    time per minibatch (forward + backward + GMM optimizer) of the GMM loss with the prior recomputed every batch
+    vs. the cached prior (set_prior_cache), with an optimizer step after every batch (as in train_dgd) and
+    with gradients accumulated over `accumulate` batches per step, and the max difference of the final parameters
+    """
+    torch.manual_seed(seed)
+    initial = GaussianMixture(n_mix_comp, dim)
+    batches = [initial.sample(batch_size) for _ in range(n_batches)]
+
+    result = {}
+    for steps_every in (1, accumulate):
+        params = {}
+        for cached in (False, True):
+            gmm = copy.deepcopy(initial).set_prior_cache(cached)
+            optimizer = torch.optim.Adam(gmm.parameters(), lr=lr)
+            optimizer.zero_grad()
+            start = time.perf_counter()
+            for i, x in enumerate(batches):
+                gmm(x).sum().backward()
+                if (i + 1) % steps_every == 0:
+                    optimizer.step()
+                    optimizer.zero_grad()
+            name = f"{'cached' if cached else 'uncached'}_step_every_{steps_every}"
+            result[f'{name}_ms'] = 1000 * (time.perf_counter() - start) / n_batches
+            params[cached] = [p.detach().clone() for p in (gmm.mean, gmm.log_var, gmm.weight)]
+        result[f'max_abs_param_diff_step_every_{steps_every}'] = max(
+            (a - b).abs().max().item() for a, b in zip(params[False], params[True]))
+    return result
+
+
+def lognb_parity(n_rows=100000, seed=1):
+    """
+    max abs. difference of fused_logNBdensity vs. logNBdensity (values, and gradients w.r.t. m and r),
+    on counts with many zeros, means down to 0 and a range of dispersions
+    """
+    torch.manual_seed(seed)
+    k = torch.poisson(torch.full((n_rows, 1), 2.)) * (torch.rand(n_rows, 1) > 0.5)
+    m = torch.cat((torch.zeros(10, 1), torch.rand(n_rows - 10, 1) * 10)).requires_grad_()
+    r = (torch.rand(1, 1) * 20 + 1).requires_grad_()
+
+    result = {}
+    values, grads = {}, {}
+    for name, fn in (('reference', logNBdensity), ('fused', fused_logNBdensity)):
+        y = fn(k, m, r)
+        values[name] = y.detach()
+        grads[name] = torch.autograd.grad(y.sum(), (m, r))
+    result['max_abs_diff'] = (values['reference'] - values['fused']).abs().max().item()
+    result['max_rel_diff_grad_m'] = ((grads['reference'][0] - grads['fused'][0]).abs()
+                                     / grads['reference'][0].abs().clamp(min=1)).max().item()
+    result['rel_diff_grad_r'] = ((grads['reference'][1] - grads['fused'][1]).abs()
+                                 / grads['reference'][1].abs().clamp(min=1)).max().item()
+    return result
+
+
+def benchmark_lognb(n_rows=1536 * 64, n_repeats=20, seed=1):
+    """time per forward + backward of logNBdensity vs. fused_logNBdensity on the cpu, for float32 and bfloat16"""
+    torch.manual_seed(seed)
+    result = {}
+    for dtype in (torch.float32, torch.bfloat16):
+        k = torch.poisson(torch.full((n_rows, 1), 2.)).to(dtype)
+        m = (torch.rand(n_rows, 1) * 10).to(dtype).requires_grad_()
+        r = torch.full((1, 1), 3.).to(dtype).requires_grad_()
+        for name, fn in (('reference', logNBdensity), ('fused', fused_logNBdensity)):
+            start = time.perf_counter()
+            for _ in range(n_repeats):
+                fn(k, m, r).sum().backward()
+            result[f'{str(dtype)[6:]}_{name}_ms'] = 1000 * (time.perf_counter() - start) / n_repeats
+    return result
+
+
+def benchmark_nb_target_terms(df=None, batch_size=1536, n_batches=200, seed=1):
+    """
+    time per batch of the NB loss (forward + backward) computing lgamma(k + 1) every batch vs. taking it from
+    FlattenedDataset.log_factorial vs. dropping it (optimization-only), and the max difference of the exact values
+    """
+    if df is None:
+        df = synthetic_counts()
+    torch.manual_seed(seed)
+    dataset = FlattenedDataset(df, scaling_type='mean').precompute_log_factorial()
+    out = NB_Module(nn.Sequential(nn.Linear(8, 1)), 1, scaling_type="mean")
+    batches = [dataset.get_batch(torch.randint(len(dataset), (batch_size,))) for _ in range(n_batches)]
+    hidden = [torch.randn(batch_size, 8) for _ in range(n_batches)]
+
+    result, values = {}, {}
+    for name, kwargs in (('computed', lambda v: {}),
+                         ('precomputed', lambda v: {'log_k_fact': dataset.log_factorial(v)}),
+                         ('dropped', lambda v: {'exact': False})):
+        start = time.perf_counter()
+        total = 0.
+        for (value, lib, *_), h in zip(batches, hidden):
+            log_prob = out.log_prob(out(h), value, lib, **kwargs(value))
+            (-log_prob.sum()).backward()
+            total += log_prob.sum().item()
+        result[f'{name}_ms'] = 1000 * (time.perf_counter() - start) / n_batches
+        values[name] = total
+    values['dropped'] -= sum(dataset.log_factorial(b[0]).sum().item() for b in batches) # back to the exact value
+    result['max_abs_diff_exact'] = max(abs(values[n] - values['computed']) for n in ('precomputed', 'dropped'))
+    return result
+
+
+def benchmark_bf16_decoder(n_samples=200, n_muts=1536, rep_dim=20, mut_dim=34, hidden_dims=[256, 256],
+                           batch_size=1536, n_batches=50, seed=1):
+    """
+    NB loss parity (relative difference of the summed loss) and rows/sec of forward + backward for the decoder
+    in float32 vs. under cpu bfloat16 autocast (Decoder.set_autocast), on the same weights and batches
+    """
+    torch.manual_seed(seed)
+    out = NB_Module(nn.Sequential(nn.Linear(hidden_dims[-1], 1)), 1, scaling_type="mean")
+    decoder = Decoder(rep_dim + mut_dim, hidden_dims, [out])
+    reps = torch.randn(n_samples, rep_dim)
+    mut_inputs = torch.randn(n_muts, mut_dim)
+    batches = []
+    for _ in range(n_batches):
+        sample_idx, mut_idx = torch.randint(n_samples, (batch_size,)), torch.randint(n_muts, (batch_size,))
+        batches.append((torch.cat((reps[sample_idx], mut_inputs[mut_idx]), dim=1),
+                        torch.poisson(torch.full((batch_size, 1), 2.)), torch.full((batch_size, 1), 2.)))
+
+    result, losses = {}, {}
+    for name, dtype in (('float32', None), ('bfloat16', torch.bfloat16)):
+        decoder.set_autocast(dtype)
+        total = 0.
+        start = time.perf_counter()
+        for z, target, lib in batches:
+            decoder.zero_grad()
+            loss = decoder.loss(decoder(z), [target], [lib])
+            loss.backward()
+            total += loss.item()
+        result[f'{name}_rows_per_sec'] = n_batches * batch_size / (time.perf_counter() - start)
+        losses[name] = total
+    decoder.set_autocast(None)
+    result['loss_rel_diff'] = abs(losses['bfloat16'] - losses['float32']) / abs(losses['float32'])
+    return result
+
+
+def benchmark_inference_export(input_dim=54, hidden_dims=[100, 100], batch_size=1536, n_batches=100, seed=1):
+    """
+    warm-up (first call) and steady-state latency per batch of the eager Decoder (as called in the notebooks,
+    grad mode left on) vs. the exported TorchScript graph loaded back from disk, and the max output difference
+    """
+    torch.manual_seed(seed)
+    out = NB_Module(nn.Sequential(nn.Linear(hidden_dims[-1], 1)), 1, scaling_type="mean")
+    decoder = Decoder(input_dim, hidden_dims, [out]).eval()
+    path = os.path.join(tempfile.mkdtemp(), 'decoder.pt')
+    export_decoder(decoder, path)
+    engine = load_decoder(path)
+    batches = [torch.randn(batch_size, input_dim) for _ in range(n_batches)]
+
+    result = {}
+    for name, fn in (('eager', decoder), ('exported', engine)):
+        start = time.perf_counter()
+        with torch.inference_mode(name == 'exported'):
+            first = fn(batches[0])[0]
+        result[f'{name}_warmup_ms'] = 1000 * (time.perf_counter() - start)
+        start = time.perf_counter()
+        with torch.inference_mode(name == 'exported'):
+            for z in batches:
+                fn(z)
+        result[f'{name}_ms'] = 1000 * (time.perf_counter() - start) / n_batches
+        result[f'{name}_first'] = first.detach()
+    result['max_abs_diff'] = (result.pop('eager_first') - result.pop('exported_first')).abs().max().item()
+    return result
+
+
+def benchmark_best_init(df=None, n_candidates=20, rep_dim=20, mut_dim=10, hidden_dims=[100, 100], batch_size=1536, seed=1):
+    """
+    seconds for the test-time initialization of learn_new_representation with one decoder call per candidate
+    and batch vs. the batched K x B scoring of best_candidates, and the fraction of samples given the same candidate
+    """
+    torch.manual_seed(seed)
+    if df is None:
+        df = synthetic_counts()
+    dataset = FlattenedDataset(df, scaling_type='mean', return_onehot=False)
+    out = NB_Module(nn.Sequential(nn.Linear(hidden_dims[-1], 1)), 1, scaling_type="mean")
+    decoder = Decoder(rep_dim + mut_dim, hidden_dims, [out]).eval()
+    candidates = torch.randn(n_candidates, rep_dim)
+    mut_rep = torch.randn(dataset.num_muts, mut_dim)
+    loader = batch_loader(dataset, batch_size=batch_size, shuffle=False)
+
+    def row_losses(z, mut_idx, value, lib):
+        X = decoder(torch.cat((z, mut_rep[mut_idx]), dim=1))
+        return decoder.loss(X[0], value, lib, mod_id=0, reduction="none").squeeze(-1)
+
+    start = time.perf_counter()
+    total = torch.zeros((n_candidates, dataset.num_samples))
+    with torch.no_grad():
+        for value, lib, sample_idx, mut_idx in loader:
+            for k, rep in enumerate(candidates):
+                total[k].index_add_(0, sample_idx, row_losses(rep.expand(len(mut_idx), -1), mut_idx, value, lib))
+    looped = torch.argmin(total, dim=0)
+    loop_s = time.perf_counter() - start
+
+    def score(block, batch):
+        value, lib, sample_idx, mut_idx = batch
+        n = len(block)
+        loss = row_losses(expand_candidates(block, len(mut_idx)), mut_idx.repeat(n), value.repeat(n, 1), lib.repeat(n, 1))
+        return loss.view(n, -1), sample_idx
+
+    start = time.perf_counter()
+    batched, _ = best_candidates(score, candidates, loader, dataset.num_samples)
+    return {
+        'loop_s': loop_s,
+        'batched_s': time.perf_counter() - start,
+        'same_choice': (looped == batched).float().mean().item(),
+    }
+
+
+def benchmark_active_set(df=None, rep_dim=20, mut_dim=10, hidden_dims=[100, 100], batch_size=1536, max_epochs=50,
+                         tolerance=1.0, lr=1e-2, seed=1):
+    """
+    seconds, sample-epochs and final summed loss of the test-time optimization with all samples for max_epochs
+    vs. with per-sample convergence (fit_representations with a tolerance), from the same initial representations
+    """
+    torch.manual_seed(seed)
+    if df is None:
+        df = synthetic_counts()
+    dataset = FlattenedDataset(df, scaling_type='mean', return_onehot=False)
+    out = NB_Module(nn.Sequential(nn.Linear(hidden_dims[-1], 1)), 1, scaling_type="mean")
+    decoder = Decoder(rep_dim + mut_dim, hidden_dims, [out]).eval().requires_grad_(False)
+    mut_rep = torch.randn(dataset.num_muts, mut_dim)
+    init = torch.randn(dataset.num_samples, rep_dim)
+    loader = batch_loader(dataset, batch_size=batch_size, shuffle=False)
+
+    result = {}
+    for name, tol in (('fixed', None), ('active_set', tolerance)):
+        rep = RepresentationLayer(n_rep=rep_dim, n_sample=dataset.num_samples, value_init=init.clone())
+
+        def batch_loss(batch):
+            value, lib, sample_idx, mut_idx = batch
+            X = decoder(torch.cat((rep(sample_idx), mut_rep[mut_idx]), dim=1))
+            return decoder.loss(X, [value], [lib])
+
+        start = time.perf_counter()
+        epochs = fit_representations(rep, batch_loss, loader, rep_optimizer(rep.parameters(), tol, lr=lr, weight_decay=0.),
+                                     max_epochs=max_epochs, tolerance=tol)
+        result[f'{name}_s'] = time.perf_counter() - start
+        result[f'{name}_sample_epochs'] = epochs.sum().item()
+        with torch.no_grad():
+            result[f'{name}_loss'] = sum(batch_loss(batch).item() for batch in loader)
+    return result
+
+
+def benchmark_multi_start(df=None, n_mix_comp=10, n_new_samples=5, top_k=4, rep_dim=20, mut_dim=10, hidden_dims=[100, 100],
+                          batch_size=1536, multi_start_epochs=5, test_epochs=20, lr=1e-2, seed=1):
+    """
+    seconds and final summed loss (reconstruction + GMM) of the test-time embedding started from the best of
+    n_new_samples samples per GMM component vs. from the best of top_k starts optimized in parallel (multi_start)
+    """
+    torch.manual_seed(seed)
+    if df is None:
+        df = synthetic_counts()
+    dataset = FlattenedDataset(df, scaling_type='mean', return_onehot=False)
+    out = NB_Module(nn.Sequential(nn.Linear(hidden_dims[-1], 1)), 1, scaling_type="mean")
+    decoder = Decoder(rep_dim + mut_dim, hidden_dims, [out]).eval().requires_grad_(False)
+    gmm = GaussianMixture(n_mix_comp, rep_dim)
+    mut_rep = torch.randn(dataset.num_muts, mut_dim)
+    loader = batch_loader(dataset, batch_size=batch_size, shuffle=False)
+    candidates = gmm.sample_new_points("sample", n_new_samples=n_new_samples)
+
+    def row_losses(z, batch):
+        value, lib, sample_idx, mut_idx = batch
+        n = len(z) // len(mut_idx)
+        X = decoder(torch.cat((z, mut_rep[mut_idx].repeat(n, 1)), dim=1))
+        return decoder.loss(X[0], value.repeat(n, 1), lib.repeat(n, 1), mod_id=0, reduction="none").view(n, -1)
+
+    def batch_loss(rep, batch): # reconstruction plus the GMM term of every row, as in DGD.loss
+        z = rep(batch[2])
+        return (row_losses(z, batch) + gmm(z)).sum()
+
+    make_optimizer = lambda params, tolerance=None: rep_optimizer(params, tolerance, lr=lr, weight_decay=0.)
+    score = lambda block, batch: (row_losses(expand_candidates(block, len(batch[0])), batch), batch[2])
+
+    result = {}
+    for name in ('best', 'multi_start'):
+        start = time.perf_counter()
+        best, total = best_candidates(score, candidates, loader, dataset.num_samples)
+        if name == 'multi_start':
+            init = multi_start(gmm, candidates, total, top_k, batch_loss, row_losses, loader, make_optimizer, multi_start_epochs)
+        else:
+            init = candidates[best].clone()
+        rep = RepresentationLayer(n_rep=rep_dim, n_sample=dataset.num_samples, value_init=init)
+        fit_representations(rep, lambda batch: batch_loss(rep, batch), loader, make_optimizer(rep.parameters()), max_epochs=test_epochs)
+        result[f'{name}_s'] = time.perf_counter() - start
+        with torch.no_grad():
+            result[f'{name}_loss'] = sum(batch_loss(rep, batch).item() for batch in loader)
+    return result
+
+
+if __name__ == '__main__':
+    for name, result in [
+        ('flat loader (rows/sec)', benchmark_flat_loader()),
+        ('resident loader (rows/sec)', benchmark_resident_loader()),
+        ('onehot transfer', benchmark_onehot_transfer()),
+        ('sparse dataset', benchmark_sparse_dataset()),
+        ('maf pipeline parity', maf_pipeline_parity()),
+        ('factorized decoder input', factorized_decoder_parity()),
+        ('grid decoding', grid_decoding_parity()),
+        ('gmm forward', benchmark_gmm_forward()),
+        ('gmm clustering', benchmark_gmm_clustering()),
+        ('supervised gmm', benchmark_supervised_gmm()),
+        ('representation step', benchmark_representation_step()),
+        ('gmm em refresh', benchmark_gmm_em()),
+        ('gmm sampling', benchmark_gmm_sampling()),
+        ('gmm prior cache', benchmark_gmm_prior()),
+        ('lognb parity', lognb_parity()),
+        ('lognb', benchmark_lognb()),
+        ('nb target terms', benchmark_nb_target_terms()),
+        ('bf16 decoder', benchmark_bf16_decoder()),
+        ('inference export', benchmark_inference_export()),
+        ('best candidate init', benchmark_best_init()),
+        ('active set optimization', benchmark_active_set()),
+        ('multi-start init', benchmark_multi_start()),
+    ]:
+        print(name, {k: round(v, 4) for k, v in result.items()})